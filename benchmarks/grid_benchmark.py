@@ -0,0 +1,87 @@
+"""
+Times building the factored GridAgent model and updating its belief on square grids.
+
+    python -m benchmarks.grid_benchmark [blocks...]
+
+Enumerating every state as a tuple, as the dense model did, and building the (A, N) arrival-state rewards,
+which grow with the number of states, are only timed while the space is small enough.
+"""
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import issparse
+
+from pcog.agent import GridAgent
+from pcog.envconf import Action, HealthObservation
+
+# Largest state space that is enumerated as tuples or given rewards
+ENUMERATION_LIMIT = 5 * 10 ** 6
+UPDATES = 100
+
+
+def _key(table):
+    return id(table) if issparse(table) else table.__array_interface__['data'][0]
+
+
+def table_bytes(transitions, observations):
+    # Actions often share a table, which is only counted once
+    tables = dict((_key(matrix), matrix) for factor in transitions.factors for matrix in factor.matrices)
+    tables.update((_key(table), table) for table in observations.tables)
+    return sum(table.data.nbytes + table.indices.nbytes + table.indptr.nbytes if issparse(table) else table.nbytes
+               for table in tables.values())
+
+
+def time_model(blocks):
+    start = time.time()
+    agent = GridAgent(blocks, blocks)
+    agent.transitions = agent.get_transitions()
+    agent.observations = agent.get_observations()
+    return time.time() - start, agent
+
+
+def time_updates(agent):
+    observation = ((0, 0), (1, 1), None, HealthObservation.GOOD)
+    start = time.time()
+    for update in range(UPDATES):
+        agent._last_action = update % Action.N
+        agent.update_belief(observation)
+    return (time.time() - start) / UPDATES
+
+
+def time_enumeration(agent):
+    if ENUMERATION_LIMIT < agent.space.S:
+        return None
+    start = time.time()
+    agent._get_all_states()
+    return time.time() - start
+
+
+def time_rewards(agent):
+    if ENUMERATION_LIMIT < agent.space.S:
+        return None
+    start = time.time()
+    agent.construct_reward()
+    return time.time() - start
+
+
+def _seconds(seconds):
+    return "-" if seconds is None else "{:.3f}".format(seconds)
+
+
+def main(sizes):
+    print("{:>6} {:>12} {:>10} {:>10} {:>12} {:>12} {:>14}".format(
+        "grid", "states", "model (s)", "MB", "update (ms)", "rewards (s)", "tuples (s)"))
+    for blocks in sizes:
+        build, agent = time_model(blocks)
+        update = time_updates(agent)
+        rewards = time_rewards(agent)
+        enumeration = time_enumeration(agent)
+        print("{:>6} {:>12} {:>10.3f} {:>10.2f} {:>12.3f} {:>12} {:>14}".format(
+            "{0}x{0}".format(blocks), agent.space.S, build,
+            table_bytes(agent.transitions, agent.observations) / 1e6, update * 1000.0,
+            _seconds(rewards), _seconds(enumeration)))
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [5, 10, 20])
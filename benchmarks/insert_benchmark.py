@@ -0,0 +1,57 @@
+"""
+Compares inserting instances one at a time with UtileSuffixMemory.insert_many.
+
+    python -m benchmarks.insert_benchmark [sizes...]
+"""
+import sys
+import time
+from random import Random
+
+from pcog.usm import UtileSuffixMemory, Instance
+
+# Small spaces keep the number of states, and with it the fringe work per instance, bounded
+ACTIONS = range(2)
+OBSERVATIONS = range(4)
+WINDOW_SIZE = 3
+
+
+def generate(size, seed=0):
+    random = Random(seed)
+    return [(random.choice(ACTIONS), random.choice(OBSERVATIONS), random.random()) for _ in xrange(size)]
+
+
+def memory():
+    return UtileSuffixMemory(window_size=WINDOW_SIZE,
+                             known_actions=list(ACTIONS),
+                             known_observations=list(OBSERVATIONS))
+
+
+def time_sequential(data):
+    usm = memory()
+    start = time.time()
+    for action, observation, reward in data:
+        usm.insert(Instance(action, observation, reward))
+    return time.time() - start, usm
+
+
+def time_batch(data):
+    usm = memory()
+    start = time.time()
+    usm.insert_many(Instance(action, observation, reward) for action, observation, reward in data)
+    return time.time() - start, usm
+
+
+def main(sizes):
+    print("{:>8} {:>12} {:>12} {:>8} {:>8}".format("size", "insert (s)", "batch (s)", "speedup", "states"))
+    for size in sizes:
+        data = generate(size)
+        sequential, usm = time_sequential(data)
+        batch, batch_usm = time_batch(data)
+        if len(usm.get_states()) != len(batch_usm.get_states()):
+            raise AssertionError("insert_many built a different tree")
+        print("{:>8} {:>12.3f} {:>12.3f} {:>8.2f} {:>8}".format(
+            size, sequential, batch, sequential / batch, len(usm.get_states())))
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [10000, 30000, 100000])
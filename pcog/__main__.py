@@ -16,6 +16,8 @@ from .envconf import Action
 from .perception import process
 from .usm import UtileSuffixMemory
 from .model_learn_agent import ModelLearnAgent
+from .model_cache import GridModelCache
+from .diagnostics import DiagnosticsSink
 
 logging.basicConfig(filename="pcog.log", filemode="w", level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -33,7 +35,7 @@ class PCogHandler(SocketServer.StreamRequestHandler):
         logger.info("Handling pcog connection request")
         self.data = self.rfile.readline().strip()
         agent = GridAgent()
-        agent.derive_model()
+        agent.derive_model(cache=self.server.model_cache)
         while self.data:
             logger.info("{} wrote:".format(self.client_address[0]))
             logger.info(self.data)
@@ -63,12 +65,26 @@ class PCogModelLearnerHandler(SocketServer.StreamRequestHandler):
         self.wfile.write("{}\n".format(action))
         self.wfile.flush()
 
+    def initial_memory(self):
+        args = self.server.args
+        if args.warm_start:
+            logger.info("Warm starting from the memory saved in %s", args.warm_start)
+            usm = UtileSuffixMemory.load(args.warm_start)
+            if args.max_instances is not None:
+                usm.max_instances = args.max_instances
+            return usm
+        return UtileSuffixMemory(
+            known_actions=list(Action.SET),
+            max_instances=args.max_instances,
+        )
+
     def handle(self):
         logger.info("Handling pcog model learning connection request")
         logger.info("Connection address: {}".format(self.client_address[0]))
-        self.agent = ModelLearnAgent(usm=UtileSuffixMemory(
-            known_actions=list(Action.SET),
-        ))
+        self.agent = ModelLearnAgent(usm=self.initial_memory(), planner=self.server.args.planner,
+                                     deadline=self.server.args.deadline,
+                                     entropy_threshold=self.server.args.entropy_threshold,
+                                     diagnostics=self.server.diagnostics)
         self.recent = self.get_line()
         self.send_action(self.agent.get_decision())
         self.recent = self.get_line()
@@ -81,6 +97,9 @@ class PCogModelLearnerHandler(SocketServer.StreamRequestHandler):
             self.send_action(self.agent.get_decision())
             logger.info("=" * 20)
             self.recent = self.get_line()
+        if self.server.args.save_memory:
+            logger.info("Saving the learnt memory to %s", self.server.args.save_memory)
+            self.agent.usm.save(self.server.args.save_memory)
 
 
 class SkinnyPCogHandler(PCogModelLearnerHandler):
@@ -102,7 +121,7 @@ class SkinnyPCogHandler(PCogModelLearnerHandler):
                 action = choice(list(Action.SET))
             else:
                 logger.info("Choosing action with belief State: %s", " ".join(map(str, pomdp_data.beliefState)))
-                action = run_skinny_pomdp(pomdp_data)
+                action = run_skinny_pomdp(pomdp_data, self.server.args.deadline)
             actions.append(action)
             self.send_raw_action(action)
             self.recent = self.get_line()
@@ -115,6 +134,41 @@ class ThreadedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 def main():
     parser = ArgumentParser()
     parser.add_argument("--skinny", help="tells pcog to interpret a POMDP off the wire", action="store_true")
+    parser.add_argument("--max-instances",
+                        help="only keep the most recent instances in the learnt memory",
+                        type=int,
+                        default=None)
+    parser.add_argument("--warm-start",
+                        help="start learning from a memory saved with UtileSuffixMemory.save",
+                        metavar="PATH",
+                        default=None)
+    parser.add_argument("--planner",
+                        help="search the model with POMCP for every decision "
+                             "or solve it once per model with PBVI, QMDP or the fast informed bound",
+                        choices=["pomcp", "pbvi", "qmdp", "fib"],
+                        default="pomcp")
+    parser.add_argument("--deadline",
+                        help="milliseconds the planner may search for each action before it returns the best one found",
+                        metavar="MS",
+                        type=int,
+                        default=None)
+    parser.add_argument("--entropy-threshold",
+                        help="act on the QMDP values of the model while the belief entropy is at most this many bits",
+                        metavar="BITS",
+                        type=float,
+                        default=None)
+    parser.add_argument("--diagnostics",
+                        help="write every learnt model to compressed arrays in this directory",
+                        metavar="DIR",
+                        default=None)
+    parser.add_argument("--model-cache",
+                        help="keep the hand crafted grid model in this directory between runs",
+                        metavar="DIR",
+                        default=None)
+    parser.add_argument("--save-memory",
+                        help="save the learnt memory when a connection closes",
+                        metavar="PATH",
+                        default=None)
     args = parser.parse_args()
 
     HOST, PORT = "localhost", 9999
@@ -122,6 +176,10 @@ def main():
         server = ThreadedServer((HOST, PORT), SkinnyPCogHandler)
     else:
         server = ThreadedServer((HOST, PORT), PCogModelLearnerHandler)
+    server.args = args
+    server.diagnostics = DiagnosticsSink(args.diagnostics) if args.diagnostics else None
+    # Every connection shares the one grid model of the process
+    server.model_cache = GridModelCache(args.model_cache)
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.daemon = True
     server_thread.start()
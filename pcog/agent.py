@@ -2,18 +2,24 @@ from .envconf import HealthObservation, DangerState, Action, DistanceObservation
 from .humanoid import Humanoid
 from .deps import MDP
 from .deps import POMDP
+from .pomcp import POMCPModel
+from .pbvi import PBVI
+from .factored import StateSpace, TransitionFactor, FactoredTransitions, FactoredObservations, ProductBelief
+from .factored import FactoredModel
 from .usm import normalise_to_one
 
 import logging
+import numpy as np
+from scipy.sparse import csr_matrix
 
 logging.basicConfig(filename="pcog.log", filemode="w", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 class GridAgent(object):
-    def __init__(self):
-        self.width_blocks = 5
-        self.height_blocks = 5
+    def __init__(self, width_blocks=5, height_blocks=5):
+        self.width_blocks = width_blocks
+        self.height_blocks = height_blocks
         self.grid_width = 30.0
         self.grid_height = 30.0
         self.L = self.height_blocks * self.width_blocks + 1
@@ -23,8 +29,17 @@ class GridAgent(object):
         self.UNKNOWN = None
         self.model = None
         self.gamma = 0.3
-        self.states = self._get_all_states()
-        self.belief = normalise_to_one([1.0 / len(self.states) for _ in self.states])
+        # Probability that a position or health level is observed as it is
+        self.observation_accuracy = 0.8
+        self.attack_reward = 2.0
+        self.eat_reward = 4.0
+        self.explore_reward = 0.2
+        # Humanoid, wolf and food cells with the unknown cell last, then the health level
+        self.space = StateSpace((self.L, self.L, self.L, HealthObservation.N))
+        self.belief = ProductBelief.uniform(self.space.shape)
+        self.transitions = None
+        self.observations = None
+        self._last_action = None
 
     def get_states(self):
         pass
@@ -33,31 +48,25 @@ class GridAgent(object):
         pass
 
     def _grid_coordinates(self):
-        return [(x, y) for x in range(self.height_blocks) for y in range(self.height_blocks)]
+        return [(x, y) for x in range(self.height_blocks) for y in range(self.width_blocks)]
+
+    def _cell_coordinates(self):
+        """
+        x and y of every known cell, in cell order.
+        """
+        return np.divmod(np.arange(self.width_blocks * self.height_blocks), self.width_blocks)
 
     def _idx(self, humanoid, wolf, food, health):
-        if food is None:
-            food_idx = self.height_blocks * self.width_blocks
-        else:
-            food_x, food_y= food
-            food_idx = food_x * self.width_blocks + food_y
-        if wolf is None:
-            wolf_idx = self.width_blocks * self.height_blocks
-        else:
-            wolf_x, wolf_y = wolf
-            wolf_idx = wolf_x * self.width_blocks + wolf_y
-        humanoid_x, humanoid_y = humanoid
-        humanoid_idx = humanoid_x * self.width_blocks + humanoid_y
-        return humanoid_idx * self.L * self.L * HealthObservation.N + wolf_idx * self.L * HealthObservation.N + food_idx * HealthObservation.N + health
+        return int(self.space.index(self._cell(humanoid), self._cell(wolf), self._cell(food), health))
 
     def _get_all_states(self):
-        coordinates = self._grid_coordinates()
-        coordinates.append(None)
-        return [(humanoid, wolf, food, health)
-                for humanoid in coordinates
-                for wolf in coordinates
-                for food in coordinates
-                for health in HealthObservation.SET]
+        """
+        Every state as a (humanoid, wolf, food, health) tuple of coordinates, in index order.
+        This enumerates the whole space, the model itself is built from `space`.
+        """
+        coordinates = self._grid_coordinates() + [None]
+        humanoid, wolf, food, health = [values.tolist() for values in self.space.unindex(np.arange(self.space.S))]
+        return [(coordinates[h], coordinates[w], coordinates[f], k) for h, w, f, k in zip(humanoid, wolf, food, health)]
 
     @staticmethod
     def _is_neighbour(a, b):
@@ -65,58 +74,63 @@ class GridAgent(object):
             return False
         ax, ay = a
         bx, by = b
-        return abs(ax - bx) <= 1 or abs(ay - by) <= 1
+        return abs(ax - bx) <= 1 and abs(ay - by) <= 1
+
+    def _neighbours(self):
+        """
+        (L, L) whether two cells are known and at most one block apart in both directions,
+        in the cell order of `_idx` with the unknown cell last.
+        """
+        cells = self.width_blocks * self.height_blocks
+        x, y = self._cell_coordinates()
+        near = np.zeros((self.L, self.L))
+        near[:cells, :cells] = (np.abs(x[:, None] - x) <= 1) & (np.abs(y[:, None] - y) <= 1)
+        return near
+
+    def _moves(self, scores):
+        """
+        Normalises (current cell, next cell) humanoid move scores. A humanoid without any move stays where it is.
+        """
+        scores = scores + np.diag(scores.sum(axis=1) == 0.0)
+        return scores / scores.sum(axis=1, keepdims=True)
+
+    def _move_onto(self, near):
+        """
+        Moves onto a neighbouring target, as a sparse matrix with a row per humanoid and target cell.
+        A humanoid out of reach stays where it is.
+        """
+        humanoid, target = np.divmod(np.arange(self.L * self.L), self.L)
+        following = np.where(0.0 < near[humanoid, target], target, humanoid)
+        return csr_matrix((np.ones(len(following)), (np.arange(len(following)), following)),
+                          shape=(self.L * self.L, self.L))
 
     def get_transitions(self):
+        # type: () -> FactoredTransitions
         """
-        T : S x A -> S
-        :return:
+        T : S x A -> S as a factor per state variable, in the order of `_idx`: humanoid, wolf, food and health.
+        The wolf wanders to neighbouring cells whatever the action, food and health keep their value.
+        Exploring moves the humanoid to a neighbouring cell or keeps it, fleeing always moves it,
+        attacking and eating move it onto a neighbouring wolf or food.
         """
-        N = self.L * self.L * self.L * HealthObservation.N
-        states = self._get_all_states()
-        T = [[[0.0 for _ in range(N)] for _ in Action.N] for _ in range(N)]
-        for statei in states:
-            for action in Action.SET:
-                for statef in states:
-                    humanoidi, wolfi, foodi, healthi = statei
-                    humanoidf, wolff, foodf, healthf = statef
-                    iidx = self._idx(humanoidi, wolfi, foodi, healthi)
-                    fidx = self._idx(humanoidf, wolff, foodf, healthf)
-                    # food position is immutable
-                    if foodf != foodi:
-                        T[iidx][action][fidx] = 0.0
-                        break
-                    if action == Action.EXPLORE:
-                        if wolff == wolfi:
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(wolfi, wolff):
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(humanoidi, humanoidf):
-                            T[iidx][action][fidx] += 1.0
-                        if humanoidi == humanoidf:
-                            T[iidx][action][fidx] += 2.0
-                    elif action == Action.ATTACK:
-                        # Attack and wolf neighbour - more likely to be in wolf position
-                        if wolff == wolfi:
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(wolfi, wolff):
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(humanoidi, wolfi) and wolff == humanoidf:
-                            T[iidx][action][fidx] += 2.0
-                    elif action == Action.EAT:
-                        # Eat and food position is neighbour more likely to be in food position
-                        if wolff == wolfi:
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(wolfi, wolff):
-                            T[iidx][action][fidx] += 1.0
-                        if self._is_neighbour(humanoidi, foodi) and foodf == humanoidi:
-                            T[iidx][action][fidx] += 2.0
-        for transition_state in T:
-            for state_action in transition_state:
-                t_norm = self.normalise(state_action)
-                for i in len(state_action):
-                    state_action[i] = t_norm[i]
-        return T
+        near = self._neighbours()
+        same = np.eye(self.L)
+        wolf = (same + near) / (same + near).sum(axis=1, keepdims=True)
+        humanoid = [None] * Action.N
+        humanoid[Action.EXPLORE] = self._moves(near + 2.0 * same)
+        humanoid[Action.FLEE] = self._moves(near * (1.0 - same))
+        humanoid[Action.ATTACK] = humanoid[Action.EAT] = self._move_onto(near)
+        parents = [None] * Action.N
+        parents[Action.EXPLORE] = parents[Action.FLEE] = (0,)
+        parents[Action.ATTACK] = (0, 1)
+        parents[Action.EAT] = (0, 2)
+        actions = range(Action.N)
+        return FactoredTransitions([
+            TransitionFactor(self.L, parents, humanoid),
+            TransitionFactor(self.L, [(1,) for _ in actions], [wolf for _ in actions]),
+            TransitionFactor(self.L, [(2,) for _ in actions], [same for _ in actions]),
+            TransitionFactor(HealthObservation.N, [(3,) for _ in actions],
+                             [np.eye(HealthObservation.N) for _ in actions]),
+        ])
 
     @staticmethod
     def normalise(array):
@@ -149,92 +163,115 @@ class GridAgent(object):
         health = HealthObservation.health_level(humanoid_state.health)
         return position, wolf, food, health
 
+    def _cell(self, coordinate):
+        """
+        Index of a discrete coordinate in the cell order of `_idx`, the unknown cell last.
+        """
+        if coordinate is None:
+            return self.width_blocks * self.height_blocks
+        x, y = coordinate
+        return min(x, self.height_blocks - 1) * self.width_blocks + min(y, self.width_blocks - 1)
+
+    def _sensor(self, size, known):
+        """
+        (size, size) probability of observing each value of a variable whose first `known` values are known:
+        the true value with `observation_accuracy`, otherwise any other known value.
+        Unknown values are observed as they are.
+        """
+        table = np.zeros((size, size))
+        table[:known, :known] = (1.0 - self.observation_accuracy) / (known - 1)
+        table[np.arange(known), np.arange(known)] = self.observation_accuracy
+        table[known:, known:] = np.eye(size - known)
+        return table
+
     def get_observations(self):
-        states = self._get_all_states()
-        O = [[[0.0 for _ in states] for a in Action.SET] for _ in states]
-        for state in states:
-            for action in Action.SET:
-                for obs in states:
-                    humanoid, wolf, food, health = state
-                    idx = self._idx(humanoid, wolf, food, health)
-                    ohumanoid, owolf, ofood, ohealth = obs
-                    oidx = self._idx(ohumanoid, owolf, ofood, ohealth)
-                    if owolf == self.UNKNOWN or ofood == self.UNKNOWN:
-                        O[idx][action][oidx] = len(states) / 1.0
-                    if ohumanoid == humanoid:
-                        O[idx][action][oidx] += 1.0
-                    if food == ofood:
-                        O[idx][action][oidx] += 1.0
-                    if wolf == owolf:
-                        O[idx][action][oidx] += 1.0
-                    if ohealth == health:
-                        O[idx][action][oidx] += 1.0
-        for observation_state in O:
-            for state_action in observation_state:
-                o_norm = self.normalise(state_action)
-                for i in len(state_action):
-                    state_action[i] = o_norm[i]
-        return O
+        # type: () -> FactoredObservations
+        """
+        O : S -> O as a table per state variable, each observed on its own.
+        An unknown position observes nothing about the variable.
+        """
+        cells = self._sensor(self.L, self.L - 1)
+        unknown = self.L - 1
+        return FactoredObservations([cells, cells, cells, self._sensor(HealthObservation.N, HealthObservation.N)],
+                                    missing=[unknown, unknown, unknown, None])
 
     def update_belief(self, observation):
+        """
+        Predicts the belief with the last planned action and corrects it with an observation
+        from `derive_observation`, one factor at a time.
+        """
+        if self._last_action is not None and self.transitions is not None:
+            self.belief = self.belief.predict(self.transitions, self._last_action)
+        if self.observations is None:
+            self.observations = self.get_observations()
         humanoid, wolf, food, health = observation
-        for idx in range(len(self.states)):
-            shumanoid, swolf, sfood, shealth = observation
-            if shumanoid == humanoid:
-                self.belief[idx] += 1.0
-            if swolf == wolf:
-                self.belief[idx] += 1.0
-            if sfood == food:
-                self.belief[idx] += 1.0
-            if shealth == health:
-                self.belief[idx] += 1.0
-        self.belief = self.normalise(self.belief)
+        observed = (self._cell(humanoid), self._cell(wolf), self._cell(food), health)
+        self.belief = self.belief.update(self.observations.likelihoods(observed))
+
+    def _arrival_rewards(self):
+        """
+        The reward of arriving in every state after every action, an array per action that broadcasts
+        against the state space. Attacking pays when the humanoid arrives on the wolf and eating when it
+        arrives on the food, neither of which can happen in the unknown cell.
+        """
+        space = self.space
+        humanoid = space.axis(0)
+        known = humanoid < self.L - 1
+        constant = [1] * len(space.shape)
+        rewards = [np.zeros(constant) for _ in Action.SET]
+        rewards[Action.ATTACK] = self.attack_reward * ((humanoid == space.axis(1)) & known)
+        rewards[Action.EAT] = self.eat_reward * ((humanoid == space.axis(2)) & known)
+        rewards[Action.EXPLORE] = np.full(constant, self.explore_reward)
+        return rewards
 
     def construct_reward(self):
-        states = self._get_all_states()
-        R = [[[0.0 for _ in states] for a in Action.SET] for _ in states]
-        for statei in states:
-            for action in Action.SET:
-                for statef in states:
-                    humanoidi, wolfi, foodi, healthi = statei
-                    humanoidf, wolff, foodf, healthf = statef
-                    iidx = self._idx(humanoidi, wolfi, foodi, healthi)
-                    fidx = self._idx(humanoidf, wolff, foodf, healthf)
-                    if action == Action.ATTACK:
-                        if humanoidf == wolff:
-                            R[iidx][action][fidx] += 2.0
-                    elif action == Action.EAT:
-                        if humanoidf == foodf:
-                            R[iidx][action][fidx] += 4.0
-                    elif action == Action.EXPLORE:
-                        R[iidx][action][fidx] = 0.2
-        return R
+        """
+        R : A x S -> reward of arriving in each state after each action, as an (A, N) array.
+        """
+        return np.stack([np.broadcast_to(r, self.space.shape).ravel() for r in self._arrival_rewards()])
+
+    def expected_rewards(self, transitions=None):
+        """
+        R : S x A -> expected reward of taking each action in each state, as an (N, A) array.
+        Every action only contracts the factors its reward depends on.
+        """
+        if transitions is None:
+            transitions = self.transitions if self.transitions is not None else self.get_transitions()
+        return np.stack([np.broadcast_to(transitions.expectation(r, a), self.space.shape).ravel()
+                         for a, r in enumerate(self._arrival_rewards())], axis=1)
 
     def set_reward(self, reward_fn):
         pass
 
-    def derive_model(self):
+    def model_key(self):
+        """
+        Everything the model depends on, see `GridModelCache`.
+        """
+        return (self.width_blocks, self.height_blocks, self.gamma, self.observation_accuracy,
+                self.attack_reward, self.eat_reward, self.explore_reward)
+
+    def derive_model(self, cache=None):
+        """
+        :param cache: A `GridModelCache` shared with other agents, which builds the factored tables only once
+        """
         logger.info("Deriving POMDP model")
         # import ipdb; ipdb.set_trace()
-        rewards = self.construct_reward()
-        transitions = self.get_transitions()
-        observations = self.get_observations()
-        S = len(self._get_all_states())
-        O = len(self._get_all_states())
-        A = len(Action.SET)
-        model = POMDP.Model(O, S, A)
-        model.setRewardFunction(rewards)
-        model.setTransitionFunction(transitions)
-        model.setObservation(observations)
-        model.setDiscount(self.gamma)
-        self.model = model
+        if cache is not None:
+            self.transitions, self.observations, rewards = cache.get(self)
+        else:
+            self.transitions = self.get_transitions()
+            self.observations = self.get_observations()
+            rewards = self.construct_reward()
+        # The factored transitions cannot be handed to AI-Toolbox, so the model is searched with the Python POMCP
+        self.model = FactoredModel(self.transitions, self.observations, rewards, self.gamma)
 
     def plan(self):
         if self.model is not None:
-            solver = POMDP.POMCPModel(self.model, 1000, 10, 1000.0)
-            action = solver.sampleAction(self.belief, 10)
+            solver = POMCPModel(self.model, 1000, 10, 1000.0)
+            action = solver.sampleAction(self.belief.joint(), 10)
             logger.info("Manual POMDP agent chose action %s",
-                        Action.qcog_action_name(action))
+                        Action.action_name(action))
+            self._last_action = action
             return action
 
 class Hybrid(object):
@@ -425,10 +462,13 @@ def run_pcog_simulation(humanoid):
     model, observations, transitions, rewards = make_pcog_simulation()
     model.setDiscount(0.95)
     horizon = 10 # 10 seconds in real time
+    b = belief_state(humanoid, observations)
+    if not hasattr(POMDP, 'IncrementalPruning'):
+        # Without AI-Toolbox the point-based solver stands in for the exact one
+        return PBVI()(model).sampleAction(b)
     solver = POMDP.IncrementalPruning(horizon, 0.0)
     solution = solver(model)
     policy = POMDP.Policy(DangerState.N, Action.N, HealthObservation.N * DistanceObservation.N, solution[1])
-    b = belief_state(humanoid, observations)
     a, ID = policy.sampleAction(b, horizon)
     return a
 
@@ -438,7 +478,10 @@ def simulate(humanoid_string):
     action = run_pcog_simulation(humanoid)
     return Action.qcog_action(action)
 
-def run_skinny_pomdp(skinny_pomdp):
+def run_skinny_pomdp(skinny_pomdp, deadline=None):
+    """
+    :param deadline: Milliseconds the search may take before it returns the best action found so far
+    """
     reward_fn = skinny_pomdp.rewardFn
     transition_fn = skinny_pomdp.transitionFn
     observation_fn = skinny_pomdp.observationFn
@@ -451,7 +494,11 @@ def run_skinny_pomdp(skinny_pomdp):
     model.setObservationFunction(observation_fn)
     model.setTransitionFunction(transition_fn)
     model.setDiscount(0.8)
-    solver = POMDP.POMCPModel(model, 1000, 1000, 10000.0)
+    if deadline is None:
+        solver = POMDP.POMCPModel(model, 1000, 1000, 10000.0)
+    else:
+        # The compiled search cannot be interrupted
+        solver = POMCPModel(model, 1000, 1000, 10000.0, deadline)
     action = solver.sampleAction(belief, 10)
     return action
 
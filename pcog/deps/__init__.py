@@ -0,0 +1,11 @@
+"""
+The AI-Toolbox bindings `MDP` and `POMDP`, built as described in the README and copied here.
+When they have not been built `POMDP` is the NumPy implementation in `pcog.pomdp`.
+"""
+try:
+    from . import MDP
+    from . import POMDP
+except ImportError:
+    from .. import pomdp as POMDP
+    # Nothing in PCog plans with fully observable models
+    MDP = None
@@ -0,0 +1,137 @@
+"""
+Model diagnostics kept off the decision path.
+
+`describe` summarises a model from a sample of its states, so logging it costs the same whatever
+the size of the model. `DiagnosticsSink` writes whole models to compressed `.npz` files from a
+background thread; the caller only hands over references to the arrays.
+
+A function is either an array with the state as its first axis or a list of one sparse matrix per
+action, as in `SparseModel`. Sparse functions are saved as the CSR arrays of the per-action
+matrices stacked row-wise: `<name>_data`, `<name>_indices`, `<name>_indptr` and `<name>_shape`.
+"""
+import logging
+import os
+import threading
+from Queue import Queue, Full
+
+import numpy as np
+from scipy.sparse import issparse, vstack
+
+logger = logging.getLogger(__name__)
+
+# Number of states that summaries are computed from
+SAMPLE_SIZE = 64
+# Sampling states for a summary leaves the global random state, which planners are seeded with, alone
+_random = np.random.RandomState()
+
+
+def _per_action(function):
+    return isinstance(function, list) and 0 < len(function) and issparse(function[0])
+
+
+def _sampled_rows(function, rows):
+    """
+    The rows of `function` for the given start states, as a dense (len(rows), A, N) array.
+    """
+    if _per_action(function):
+        return np.stack([matrix[rows].toarray() for matrix in function], axis=1)
+    sample = np.asarray(function)[rows]
+    return sample if sample.ndim == 3 else sample[:, :, np.newaxis]
+
+
+def _shape(function):
+    if _per_action(function):
+        S, N = function[0].shape
+        return S, len(function), N
+    return np.shape(function)
+
+
+def describe(transitions, observations, rewards, sample=SAMPLE_SIZE):
+    # type: (...) -> str
+    """
+    Shapes, fraction of non-zero probabilities and largest row sum error of the transition and observation
+    functions and the reward range, measured on `sample` randomly chosen states.
+    """
+    S = _shape(transitions)[0]
+    rows = np.arange(S) if S <= sample else np.sort(_random.choice(S, size=sample, replace=False))
+    parts = []
+    for name, function in (("transitions", transitions), ("observations", observations)):
+        values = _sampled_rows(function, rows)
+        error = np.abs(values.sum(axis=2) - 1.0).max() if 0 < values.size else 0.0
+        parts.append("{} {}: {:.1%} non-zero, row sum error {:.2g}".format(
+            name, _shape(function), np.count_nonzero(values) / float(max(values.size, 1)), error))
+    values = _sampled_rows(rewards, rows)
+    if 0 < values.size:
+        parts.append("rewards {}: {:.3g} to {:.3g}".format(_shape(rewards), values.min(), values.max()))
+    return "{} (from {} of {} states)".format("; ".join(parts), len(rows), S)
+
+
+def _arrays(name, function):
+    if _per_action(function):
+        stacked = vstack(function, format='csr')
+        return {name + '_data': stacked.data,
+                name + '_indices': stacked.indices,
+                name + '_indptr': stacked.indptr,
+                name + '_shape': np.array(_shape(function))}
+    return {name: np.asarray(function)}
+
+
+class DiagnosticsSink(object):
+    """
+    Writes model snapshots as `model-<n>.npz` in `directory` from a daemon thread.
+    Snapshots that arrive while `max_pending` others are waiting are dropped rather than slowing the caller.
+    Submitted arrays must not be changed afterwards.
+    """
+    def __init__(self, directory, max_pending=4):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._queue = Queue(max_pending)
+        self.submitted = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="pcog-diagnostics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, **functions):
+        """
+        Queues the named functions to be written as one snapshot. Returns whether the snapshot was queued.
+        """
+        try:
+            self._queue.put_nowait((self.submitted, functions))
+        except Full:
+            self.dropped += 1
+            logger.info("Dropped a model snapshot, %d snapshots are still being written", self._queue.qsize())
+            return False
+        self.submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                number, functions = item
+                arrays = {}
+                for name, function in functions.items():
+                    arrays.update(_arrays(name, function))
+                path = os.path.join(self.directory, "model-{:04d}.npz".format(number))
+                np.savez_compressed(path, **arrays)
+            except Exception:
+                logger.exception("Could not write a model snapshot")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Waits until every queued snapshot has been written.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes the queued snapshots and stops the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,319 @@
+"""
+Factored (dynamic Bayesian network) POMDP models.
+
+A state is a tuple of factor values and its flat index is the C-order index of that tuple,
+so a joint belief is an array with one axis per factor. Each factor of the next state depends on
+a few factors of the current state, its parents, through a conditional table per action.
+The joint transition function is never built: predictions contract the belief with one table
+per factor and samples draw one factor at a time.
+
+Observations are factored too, every observed variable depending on one state factor only, so a
+belief can also be kept as a product of per-factor marginals (`ProductBelief`). Predicting and
+correcting that belief costs the size of the tables rather than the number of states, at the price
+of forgetting the correlations between factors after every step.
+"""
+from bisect import bisect_right
+from random import random
+from string import ascii_lowercase, ascii_uppercase
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from typing import List
+
+from .sparse_model import row_sampler, sample_row
+
+
+class StateSpace(object):
+    """
+    States as tuples of factor values, numbered in C order: a mixed radix number whose last factor changes fastest.
+    Indexing works on arrays of values, and `axis` and `broadcast` shape per-factor arrays so that expressions
+    over the whole space broadcast without ever enumerating it.
+    """
+    def __init__(self, shape):
+        self.shape = tuple(int(size) for size in shape)
+        self.S = int(np.prod(self.shape, dtype=np.int64))
+        self.strides = tuple(int(np.prod(self.shape[f + 1:], dtype=np.int64)) for f in range(len(self.shape)))
+
+    def index(self, *values):
+        """
+        Flat indices of the states with the given factor values, which may be broadcastable arrays.
+        """
+        return np.ravel_multi_index(np.broadcast_arrays(*values), self.shape)
+
+    def unindex(self, s):
+        """
+        The factor values of flat indices, one array per factor.
+        """
+        return np.unravel_index(s, self.shape)
+
+    def axis(self, f):
+        """
+        The values of factor `f` shaped to broadcast along its axis of the space.
+        """
+        return self.broadcast(np.arange(self.shape[f]), f)
+
+    def values(self, f):
+        """
+        The value of factor `f` in every state, with one axis per factor. A view that takes no memory.
+        """
+        return np.broadcast_to(self.axis(f), self.shape)
+
+    def broadcast(self, array, *factors):
+        """
+        Reshapes an array with one axis per given factor, in increasing order, to broadcast against the space.
+        """
+        shape = [1] * len(self.shape)
+        for f in factors:
+            shape[f] = self.shape[f]
+        return np.reshape(array, shape)
+
+
+class TransitionFactor(object):
+    def __init__(self, size, parents, tables):
+        """
+        :param size: Number of values of the factor
+        :param parents: A tuple per action with the indices of the factors the next value depends on
+        :param tables: A table per action, each row a probability distribution over the next value:
+        either an array with an axis per parent followed by the next value,
+        or a sparse matrix with a row per combination of parent values in C order
+        """
+        self.size = size
+        self.parents = [tuple(p) for p in parents]
+        self.matrices = [csr_matrix(t) if issparse(t) else np.reshape(np.asarray(t, dtype=np.float64), (-1, size))
+                         for t in tables]
+        for parents, table, matrix in zip(self.parents, tables, self.matrices):
+            if matrix.shape[1] != size or not (issparse(table) or np.ndim(table) == len(parents) + 1):
+                raise ValueError("Table of shape {} does not match {} parents and {} values".format(
+                    table.shape, len(parents), size))
+            if not np.allclose(np.asarray(matrix.sum(axis=1)).ravel(), 1.0):
+                raise ValueError("Transition factor contains rows that are not probability distributions")
+        self._samplers = [row_sampler(csr_matrix(matrix)) for matrix in self.matrices]
+
+    def table(self, a, parent_shape):
+        """
+        The dense table of action `a` with an axis per parent followed by the next value.
+        """
+        matrix = self.matrices[a]
+        return (matrix.toarray() if issparse(matrix) else matrix).reshape(tuple(parent_shape) + (self.size,))
+
+    def sample(self, a, row):
+        return sample_row(self._samplers[a], row)
+
+    def probability(self, a, row, value):
+        return self.matrices[a][row, value]
+
+
+class FactoredTransitions(object):
+    def __init__(self, factors):
+        # type: (List[TransitionFactor]) -> None
+        self.factors = factors
+        self.space = StateSpace([f.size for f in factors])
+        self.shape = self.space.shape
+        self.S = self.space.S
+        self.A = len(factors[0].matrices)
+        if len(factors) > len(ascii_lowercase):
+            raise ValueError("At most {} factors are supported".format(len(ascii_lowercase)))
+        # Parents and their strides, to number the rows of every factor's table
+        self._rows = [[zip(parents, StateSpace([self.shape[p] for p in parents]).strides)
+                       for parents in factor.parents] for factor in factors]
+        self._tables = {}
+
+    def _prediction(self, a):
+        """
+        The einsum subscripts and dense tables that contract a joint belief with every factor of action `a`.
+        """
+        if a not in self._tables:
+            current = ascii_lowercase[:len(self.factors)]
+            following = ascii_uppercase[:len(self.factors)]
+            operands, tables = [current], []
+            for f, factor in enumerate(self.factors):
+                parents = factor.parents[a]
+                operands.append("".join(current[p] for p in parents) + following[f])
+                tables.append(factor.table(a, [self.shape[p] for p in parents]))
+            self._tables[a] = ",".join(operands) + "->" + following, tables
+        return self._tables[a]
+
+    def _row(self, f, a, state):
+        return sum(state[parent] * stride for parent, stride in self._rows[f][a])
+
+    def index(self, state):
+        return int(self.space.index(*state))
+
+    def unindex(self, s):
+        return tuple(int(v) for v in self.space.unindex(s))
+
+    def predict(self, belief, a):
+        """
+        The belief over next states after taking `a`, with the same shape as `belief`:
+        either one axis per factor or flat. The whole joint is kept, so this suits small spaces only,
+        see `ProductBelief` for large ones.
+        """
+        subscripts, tables = self._prediction(a)
+        predicted = np.einsum(subscripts, np.reshape(belief, self.shape), *tables, optimize=True)
+        return predicted.reshape(np.shape(belief))
+
+    def expectation(self, values, a):
+        """
+        The expected value of `values` after taking `a` in every state.
+        `values` has an axis per factor and only varies along some of them, like the arrays of
+        `StateSpace.broadcast`. Only the tables of those factors are contracted, so the result only
+        varies along their parents and broadcasts against the space the same way.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        varying = [f for f in range(len(self.shape)) if values.shape[f] != 1]
+        current = ascii_lowercase[:len(self.factors)]
+        following = ascii_uppercase[:len(self.factors)]
+        operands = [values.reshape([self.shape[f] for f in varying])]
+        subscripts = ["".join(following[f] for f in varying)]
+        parents = set()
+        for f in varying:
+            factor = self.factors[f]
+            operands.append(factor.table(a, [self.shape[p] for p in factor.parents[a]]))
+            subscripts.append("".join(current[p] for p in factor.parents[a]) + following[f])
+            parents.update(factor.parents[a])
+        parents = sorted(parents)
+        expected = np.einsum(",".join(subscripts) + "->" + "".join(current[p] for p in parents), *operands)
+        return self.space.broadcast(expected, *parents)
+
+    def sample(self, s, a):
+        """
+        Samples the flat index of the next state after taking `a` in the state with flat index `s`.
+        """
+        state = self.unindex(s)
+        return self.index([factor.sample(a, self._row(f, a, state)) for f, factor in enumerate(self.factors)])
+
+    def probability(self, s, a, s1):
+        state, following = self.unindex(s), self.unindex(s1)
+        p = 1.0
+        for f, (value, factor) in enumerate(zip(following, self.factors)):
+            p *= factor.probability(a, self._row(f, a, state), value)
+        return p
+
+
+class FactoredObservations(object):
+    def __init__(self, tables, missing=None):
+        """
+        :param tables: An (values of the state factor, values of the observation) array per state factor,
+        each row a probability distribution
+        :param missing: Per factor the observation value that carries no information, such as an unseen
+        position, or None. Correcting a belief with it leaves the factor alone.
+        """
+        self.tables = [np.asarray(t, dtype=np.float64) for t in tables]
+        for table in self.tables:
+            if not np.allclose(table.sum(axis=-1), 1.0):
+                raise ValueError("Observation factor contains rows that are not probability distributions")
+        self.missing = [None] * len(self.tables) if missing is None else list(missing)
+        self.shape = tuple(t.shape[1] for t in self.tables)
+        self.O = int(np.prod(self.shape))
+        self._cumulative = [np.cumsum(table, axis=-1).tolist() for table in self.tables]
+
+    def index(self, observation):
+        return int(np.ravel_multi_index(observation, self.shape))
+
+    def likelihoods(self, observation):
+        """
+        The likelihood of every value of every state factor given an observation tuple,
+        None for the factors whose observation is missing.
+        """
+        return [None if o == missing else table[:, o]
+                for o, missing, table in zip(observation, self.missing, self.tables)]
+
+    def sample(self, state):
+        """
+        Samples an observation tuple in `state`, a tuple of state factor values.
+        """
+        return tuple(min(bisect_right(rows[value], random() * rows[value][-1]), len(rows[value]) - 1)
+                     for value, rows in zip(state, self._cumulative))
+
+
+class ProductBelief(object):
+    """
+    A belief kept as one marginal distribution per factor.
+    """
+    def __init__(self, marginals):
+        self.marginals = [np.asarray(m, dtype=np.float64) for m in marginals]
+
+    @classmethod
+    def uniform(cls, shape):
+        return cls([np.full(size, 1.0 / size) for size in shape])
+
+    def predict(self, transitions, a):
+        # type: (FactoredTransitions, int) -> ProductBelief
+        """
+        The marginals after taking `a`, each factor contracted with the marginals of its parents.
+        """
+        predicted = []
+        for factor in transitions.factors:
+            # The joint of the parents, in the row order of the factor's table
+            parents = np.ones(1)
+            for p in factor.parents[a]:
+                parents = np.outer(parents, self.marginals[p]).ravel()
+            predicted.append(factor.matrices[a].T.dot(parents))
+        return ProductBelief(predicted)
+
+    def update(self, likelihoods):
+        """
+        The marginals corrected by the likelihoods of an observation, see `FactoredObservations.likelihoods`.
+        A factor whose observation is impossible under its marginal keeps the marginal.
+        """
+        updated = []
+        for marginal, likelihood in zip(self.marginals, likelihoods):
+            if likelihood is not None and 0.0 < marginal.dot(likelihood):
+                marginal = marginal * likelihood
+                marginal /= marginal.sum()
+            updated.append(marginal)
+        return ProductBelief(updated)
+
+    def joint(self):
+        """
+        The flat joint belief, in the C order of the factors.
+        """
+        joint = np.ones(1)
+        for marginal in self.marginals:
+            joint = np.outer(joint, marginal).ravel()
+        return joint
+
+
+class FactoredModel(object):
+    """
+    A generative model over factored transitions and observations for the sampling planners in this package.
+    """
+    def __init__(self, transitions, observations, rewards, discount=1.0):
+        """
+        :param transitions: `FactoredTransitions`
+        :param observations: `FactoredObservations`, observation indices are the C-order index of the tuple
+        :param rewards: (A, S) reward of arriving in every state after every action
+        """
+        self.transitions = transitions
+        self.observations = observations
+        self.rewards = rewards
+        self.discount = discount
+        self.S = transitions.S
+        self.A = transitions.A
+        self.O = observations.O
+
+    def getS(self):
+        return self.S
+
+    def getA(self):
+        return self.A
+
+    def getO(self):
+        return self.O
+
+    def getDiscount(self):
+        return self.discount
+
+    def setDiscount(self, discount):
+        self.discount = discount
+
+    def getTransitionProbability(self, s, a, s1):
+        return self.transitions.probability(s, a, s1)
+
+    def getExpectedReward(self, s, a, s1):
+        return self.rewards[a][s1]
+
+    def sampleSOR(self, s, a):
+        s1 = self.transitions.sample(s, a)
+        o = self.observations.index(self.observations.sample(self.transitions.unindex(s1)))
+        return s1, o, self.rewards[a][s1]
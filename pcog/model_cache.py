@@ -0,0 +1,152 @@
+"""
+A process-wide cache of the factored GridAgent model.
+
+The model, its transitions, observations and arrival-state rewards, only depends on the parameters in
+`GridAgent.model_key`, so it is built once per process and shared by every connection. The arrays are
+never written to once built, so handler threads share them without locking. With a directory the model is also saved as `.npy` files and loaded memory-mapped
+read-only, so a restarted process answers without building it again.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from .factored import TransitionFactor, FactoredTransitions, FactoredObservations
+
+logger = logging.getLogger(__name__)
+
+
+class _TableWriter(object):
+    """
+    Saves every distinct table once and names it in the manifest.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = {}
+
+    def _save(self, name, array):
+        np.save(os.path.join(self.directory, name + ".npy"), np.asarray(array))
+
+    def __call__(self, table):
+        key = (table.data if issparse(table) else table).__array_interface__['data'][0]
+        if key not in self.names:
+            name = "t{}".format(len(self.names))
+            if issparse(table):
+                for part in ("data", "indices", "indptr"):
+                    self._save("{}_{}".format(name, part), getattr(table, part))
+                self.names[key] = {"name": name, "sparse": list(table.shape)}
+            else:
+                self._save(name, table)
+                self.names[key] = {"name": name}
+        return self.names[key]
+
+
+def _read(directory, table):
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+    if "sparse" in table:
+        parts = [load("{}_{}".format(table["name"], part)) for part in ("data", "indices", "indptr")]
+        return csr_matrix(tuple(parts), shape=tuple(table["sparse"]), copy=False)
+    return load(table["name"])
+
+
+def save_model(directory, key, transitions, observations, rewards):
+    # type: (str, tuple, FactoredTransitions, FactoredObservations, np.ndarray) -> None
+    """
+    Writes the model to `directory`, which must not exist yet.
+    """
+    write = _TableWriter(directory)
+    os.makedirs(directory)
+    factors = []
+    for factor in transitions.factors:
+        tables = []
+        for a, (parents, matrix) in enumerate(zip(factor.parents, factor.matrices)):
+            # Dense tables keep their parent axes
+            tables.append(write(matrix if issparse(matrix) else
+                                factor.table(a, [transitions.shape[p] for p in parents])))
+        factors.append({"size": factor.size, "parents": [list(p) for p in factor.parents], "tables": tables})
+    manifest = {
+        "key": list(key),
+        "factors": factors,
+        "observations": {"tables": [write(table) for table in observations.tables],
+                         "missing": observations.missing},
+        "rewards": write(rewards),
+    }
+    with open(os.path.join(directory, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+def load_model(directory):
+    """
+    The key, transitions, observations and rewards saved in `directory`, with memory-mapped read-only tables.
+    """
+    with open(os.path.join(directory, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    factors = [TransitionFactor(factor["size"], factor["parents"], [_read(directory, t) for t in factor["tables"]])
+               for factor in manifest["factors"]]
+    observations = manifest["observations"]
+    return (tuple(manifest["key"]),
+            FactoredTransitions(factors),
+            FactoredObservations([_read(directory, t) for t in observations["tables"]], observations["missing"]),
+            _read(directory, manifest["rewards"]))
+
+
+class GridModelCache(object):
+    def __init__(self, directory=None):
+        """
+        :param directory: Where models are saved between processes, or None to keep them in memory only
+        """
+        self.directory = directory
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, "grid-" + hashlib.sha1(repr(key)).hexdigest()[:16])
+
+    def _load(self, key):
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return None
+        saved, transitions, observations, rewards = load_model(path)
+        if list(saved) != list(key):
+            logger.info("Ignoring the model in %s, it was saved for %s", path, saved)
+            return None
+        logger.info("Loaded the grid model from %s", path)
+        return transitions, observations, rewards
+
+    def _save(self, key, transitions, observations, rewards):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Written aside and renamed so that other processes never see half a model
+        staging = tempfile.mkdtemp(dir=self.directory)
+        try:
+            save_model(os.path.join(staging, "model"), key, transitions, observations, rewards)
+            os.rename(os.path.join(staging, "model"), self._path(key))
+            logger.info("Saved the grid model to %s", self._path(key))
+        except OSError:
+            logger.exception("Could not save the grid model")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def get(self, agent):
+        """
+        The transitions, observations and (A, S) arrival-state rewards of `agent`'s model,
+        built by the agent only when no process has yet.
+        """
+        key = agent.model_key()
+        with self._lock:
+            if key not in self._models:
+                model = self._load(key) if self.directory is not None else None
+                if model is None:
+                    logger.info("Building the grid model for %s", key)
+                    model = agent.get_transitions(), agent.get_observations(), agent.construct_reward()
+                    if self.directory is not None:
+                        self._save(key, *model)
+                self._models[key] = model
+            return self._models[key]
@@ -3,11 +3,21 @@ from random import choice, random
 from datetime import datetime
 import pickle
 
+import numpy as np
+
 from .usm import UtileSuffixMemory, Instance
 from .envconf import Action
 from .perception import Perceptor, SimplePerceptor, ComplexPerceptor
 from .usm_draw import update_usm_drawing, draw_usm
-from .usm_pomdp import build_pomdp_model, solve, belief_state
+from .usm_pomdp import IncrementalModel, BeliefIndex, SearchPlanner, solve
+from .pbvi import PBVI
+from .qmdp import QMDP, FIB, entropy
+from .diagnostics import DiagnosticsSink
+
+# Planners that ModelLearnAgent can plan with
+PLANNERS = ('pomcp', 'pbvi', 'qmdp', 'fib')
+# Planners that solve the model once per regeneration
+SOLVERS = {'pbvi': PBVI, 'qmdp': QMDP, 'fib': FIB}
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +30,23 @@ class ModelLearnAgent(object):
                  perceptive_window=3,
                  epsilon=0.1,
                  save_perceptions=False,
-                 use_smart_explore=True):
-        # type: (UtileSuffixMemory, Perceptor, int, int, bool) -> None
+                 use_smart_explore=True,
+                 use_sparse_model=False,
+                 planner='pomcp',
+                 deadline=None,
+                 entropy_threshold=None,
+                 diagnostics=None):
+        # type: (UtileSuffixMemory, Perceptor, int, int, bool, bool, str, int, float, DiagnosticsSink) -> None
+        """
+        :param planner: 'pomcp' searches the model for every decision,
+        'pbvi', 'qmdp' and 'fib' solve it once per regeneration and then only evaluate the alpha vectors of the solution
+        :param deadline: Milliseconds a POMCP search may take before it returns the best action found so far
+        :param entropy_threshold: Bits of belief entropy up to which decisions are taken with the QMDP values
+        of the model, leaving only more uncertain beliefs to the planner
+        :param diagnostics: A `DiagnosticsSink` that every regenerated model is written to
+        """
+        if planner not in PLANNERS:
+            raise ValueError("Unknown planner {}, expected one of {}".format(planner, ", ".join(PLANNERS)))
         if usm:
             self.usm = usm
         else:
@@ -34,10 +59,19 @@ class ModelLearnAgent(object):
         self._perception_window = perceptive_window
         self._perception_factory = perceptor
         self.model = None
+        self._model_builder = IncrementalModel(self.usm)
         self._should_save_perceptions = save_perceptions
         self._has_saved_perceptions = False
         self._state_distribution = None
         self._use_smart_explore = use_smart_explore
+        self._use_sparse_model = use_sparse_model
+        self._planner = planner
+        self._policy = None
+        self._search = None
+        self._deadline = deadline
+        self._fast_policy = None
+        self._entropy_threshold = entropy_threshold
+        self._diagnostics = diagnostics
         self.epsilon = epsilon
         self.regens = 0
         self.max_regens = 6
@@ -75,8 +109,21 @@ class ModelLearnAgent(object):
                         , str(observation)
                         , str(action)
                         , str(reward))
+        self._trim_history()
         self._iterations += 1
 
+    def _trim_history(self):
+        """
+        Keeps the perception, action and reward history as short as the memory's instance window.
+        """
+        limit = self.usm.max_instances
+        if limit is None:
+            return
+        # The most recent seven actions are used to detect repetition
+        limit = max(limit, 7)
+        for history in (self._perceptions, self._actions, self._rewards):
+            del history[:-limit]
+
     def _repeating_actions(self):
         if 0 == len(self._actions):
             return True
@@ -90,33 +137,56 @@ class ModelLearnAgent(object):
             pickle.dump(self._perceptions, save_file)
             self._has_saved_perceptions = True
 
+    def _should_regenerate(self):
+        if self.max_regens < self.regens:
+            return False
+        if (self._iterations + 1) % self.max_exploration_iterations == 0:
+            return True
+        # A warm started memory can be planned with before any exploration
+        return self.model is None and self._iterations == 0 and 0 < len(self.usm.get_instances())
+
     def get_decision(self):
-        if (self._iterations + 1) % self.max_exploration_iterations == 0 and self.regens <= self.max_regens:
+        if self._should_regenerate():
             if not self._has_saved_perceptions and self._should_save_perceptions:
                 self._save_perceptions()
-            # self.usm.unfringe()
+            self.usm.unfringe()
             #draw_usm(self.usm)
-            pomdp = build_pomdp_model(self.usm)
+            # Only the rows touched since the last regeneration are recomputed
+            self._model_builder.update()
+            pomdp = self._model_builder.model(sparse=self._use_sparse_model, diagnostics=self._diagnostics)
             self.regens += 1
-            usm = self.usm.derive_new()
-            self.model = (usm, pomdp)
+            # The memory keeps learning, the model keeps the states it was built with
+            beliefs = BeliefIndex(self.usm, list(self._model_builder.states))
+            self.model = (self.usm, pomdp, beliefs)
+            if self._entropy_threshold is not None:
+                self._fast_policy = QMDP()(pomdp)
+            if self._planner in SOLVERS:
+                self._policy = SOLVERS[self._planner]()(pomdp)
+            else:
+                # The search tree is kept between decisions until the next regeneration
+                self._search = SearchPlanner(self.usm, pomdp, beliefs, deadline=self._deadline)
             if len(self.usm.get_instances()) == 0:
                 raise ValueError("Attempting to plan with a model that has no perceptions")
-            beliefs = belief_state(self.usm, self.usm.get_instances()[-self._perception_window:])
-            if self._state_distribution is None:
-                self._state_distribution = beliefs
-            else:
-                for i in range(len(self._state_distribution)):
-                    self._state_distribution[i] += beliefs[i]
+            distribution = np.array(beliefs.belief(self.usm.get_instances()[-self._perception_window:]))
+            if self._state_distribution is not None and len(self._state_distribution) <= len(distribution):
+                # State indices start over when the model is rebuilt
+                distribution[:len(self._state_distribution)] += self._state_distribution
+            self._state_distribution = distribution
             logger.info("Belief distribution: {}".format(self._state_distribution))
         if self.max_regens < self.regens and (self._iterations + 1) % self.max_exploration_iterations == 0:
             logger.info("Not performing regeneration because regeneration limit has been reached")
         if self.model is not None and self.epsilon < random():
             logger.info("Making decision No. %d with POMDP model", self._iterations)
-            usm, model = self.model
-            action = solve(usm,
-                           model,
-                           self.usm.get_instances()[-self._perception_window:])
+            usm, model, beliefs = self.model
+            past_perceptions = self.usm.get_instances()[-self._perception_window:]
+            belief = beliefs.belief(past_perceptions)
+            if self._fast_policy is not None and entropy(belief) <= self._entropy_threshold:
+                logger.info("Belief entropy is below %g bits, acting on the QMDP values", self._entropy_threshold)
+                action = self._fast_policy.sampleAction(belief)
+            elif self._search is not None:
+                action = self._search.decide(past_perceptions)
+            else:
+                action = solve(usm, model, past_perceptions, beliefs=beliefs, policy=self._policy)
             self._actions.append(action)
             return action
         else:
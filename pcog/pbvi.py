@@ -0,0 +1,172 @@
+"""
+Point-based value iteration.
+
+A model is solved once for a fixed set of beliefs: the uniform belief, every certain belief and the beliefs
+reached by random walks from the uniform belief. The result is a set of alpha vectors, each tagged with an action,
+so acting on a belief is a single matrix-vector product and an argmax.
+
+Iterations follow Perseus: random beliefs are backed up until every belief is at least as good as before,
+so most iterations need far fewer backups than there are beliefs and the number of vectors stays small.
+Each backup is vectorised over every observation and works on the per-action CSR matrices of the model,
+so it costs the number of non-zero probabilities rather than S^2.
+"""
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .sparse_model import SparseModel
+from . import pomdp
+
+logger = logging.getLogger(__name__)
+
+
+def model_matrices(model):
+    """
+    A CSR (S, S) transition and (S, O) observation matrix per action and (S, A) expected rewards of
+    a `SparseModel`, a `pcog.pomdp.Model` or an AI-Toolbox model. The matrices of a `SparseModel`
+    are used as they are, the other models hold dense functions that are converted.
+    """
+    if isinstance(model, SparseModel):
+        return model.transitions, model.observations, model.rewards
+    if isinstance(model, pomdp.Model):
+        transitions, observations, rewards = model.transitions, model.observations, model.rewards
+    else:
+        S, A, O = model.getS(), model.getA(), model.getO()
+        transitions = np.array([[[model.getTransitionProbability(s, a, s1) for s1 in range(S)]
+                                 for a in range(A)] for s in range(S)])
+        observations = np.array([[[model.getObservationProbability(s1, a, o) for o in range(O)]
+                                  for a in range(A)] for s1 in range(S)])
+        rewards = np.array([[[model.getExpectedReward(s, a, s1) for s1 in range(S)]
+                             for a in range(A)] for s in range(S)])
+    if rewards.ndim == 3:
+        rewards = (transitions * rewards).sum(axis=2)
+    A = transitions.shape[1]
+    return ([csr_matrix(transitions[:, a, :]) for a in range(A)],
+            [csr_matrix(observations[:, a, :]) for a in range(A)],
+            rewards)
+
+
+def _sample(matrix, row):
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    return np.random.choice(matrix.indices[start:end], p=matrix.data[start:end] / matrix.data[start:end].sum())
+
+
+class AlphaVectorPolicy(object):
+    def __init__(self, alphas, actions):
+        """
+        :param alphas: (K, S) value of every vector in every state
+        :param actions: (K,) action that every vector starts with
+        """
+        self.alphas = alphas
+        self.actions = actions
+
+    def value(self, belief):
+        return float(self.alphas.dot(belief).max())
+
+    def sampleAction(self, belief, horizon=None):
+        """
+        The best action for `belief`. The horizon is accepted for compatibility with POMCP and ignored.
+        """
+        return int(self.actions[self.alphas.dot(belief).argmax()])
+
+
+class PBVI(object):
+    def __init__(self, belief_size=200, iterations=100, epsilon=1e-3):
+        """
+        :param belief_size: Number of beliefs reached by random walks, on top of the uniform and certain beliefs
+        :param iterations: Maximum number of backups of the whole belief set
+        :param epsilon: The values are converged once no belief gains more than this in an iteration
+        """
+        self.belief_size = belief_size
+        self.iterations = iterations
+        self.epsilon = epsilon
+
+    def __call__(self, model):
+        return self.solve(model)
+
+    def _beliefs(self, transitions, observations):
+        S, O = observations[0].shape
+        A = len(transitions)
+        columns = [o.tocsc() for o in observations]
+        beliefs = [np.full(S, 1.0 / S)] + list(np.eye(S))
+        belief, s = beliefs[0], np.random.randint(S)
+        for _ in range(self.belief_size):
+            a = np.random.randint(A)
+            s = _sample(transitions[a], s)
+            o = _sample(observations[a], s)
+            belief = transitions[a].T.dot(belief) * columns[a][:, o].toarray().ravel()
+            if belief.sum() <= 0.0:
+                belief, s = beliefs[0], np.random.randint(S)
+            else:
+                belief = belief / belief.sum()
+                beliefs.append(belief)
+        # Walks often revisit the same beliefs and every copy would cost a backup
+        _, unique = np.unique(np.round(beliefs, 9), axis=0, return_index=True)
+        return np.array(beliefs)[np.sort(unique)]
+
+    @staticmethod
+    def _arrivals(observations):
+        entries = observations.tocoo()
+        # A row per observation so that it lines up with the arrival states
+        return observations.T.tocsr(), entries.row, entries.col, entries.data
+
+    def _backup(self, belief, predicted, alphas, transitions, arrivals, rewards, discount):
+        """
+        The best vector for `belief` one step back from `alphas`, and the action it starts with.
+        :param predicted: (A, S) probability of the belief arriving in each state after each action
+        :param arrivals: Per action the (O, S) observation matrix and the arrival states, observations and
+        probabilities of its non-zero entries
+        """
+        S = len(belief)
+        backed_up = np.empty((len(transitions), S))
+        for a, (matrix, (observed, states, seen, probabilities)) in enumerate(zip(transitions, arrivals)):
+            # Value of every vector after every observation, the belief joined with the observation
+            best = observed.dot(alphas.T * predicted[a][:, np.newaxis]).argmax(axis=1)
+            # Each best vector weighted by the probability of its observation, summed over observations
+            # and projected back through the transitions
+            weighted = np.bincount(states, probabilities * alphas[best[seen], states], minlength=S)
+            backed_up[a] = rewards[:, a] + discount * matrix.dot(weighted)
+        action = backed_up.dot(belief).argmax()
+        return backed_up[action], action
+
+    def solve(self, model):
+        # type: (...) -> AlphaVectorPolicy
+        transitions, observations, rewards = model_matrices(model)
+        discount = model.getDiscount()
+        S = transitions[0].shape[0]
+        beliefs = self._beliefs(transitions, observations)
+        N = len(beliefs)
+        # Probability of every belief arriving in each state after each action, as (N, A, S)
+        predicted = np.stack([t.T.dot(beliefs.T).T for t in transitions], axis=1)
+        arrivals = [self._arrivals(o) for o in observations]
+        # Repeating the action with the best worst case reward bounds the values from below
+        lowest = rewards.min(axis=0).max()
+        worst = lowest / (1.0 - discount) if discount < 1.0 else lowest * self.iterations
+        alphas = np.full((1, S), worst)
+        actions = np.zeros(1, dtype=np.int64)
+        values = beliefs.dot(alphas.T).max(axis=1)
+        for iteration in range(self.iterations):
+            # Back up random beliefs until every belief is at least as good as before, as in Perseus
+            new_alphas, new_actions = [], []
+            new_values = np.full(N, -np.inf)
+            pending = np.arange(N)
+            while 0 < len(pending):
+                n = pending[np.random.randint(len(pending))]
+                alpha, action = self._backup(beliefs[n], predicted[n], alphas, transitions, arrivals,
+                                             rewards, discount)
+                if beliefs[n].dot(alpha) < values[n]:
+                    # The belief keeps the vector it had
+                    previous = beliefs[n].dot(alphas.T).argmax()
+                    alpha, action = alphas[previous], actions[previous]
+                new_alphas.append(alpha)
+                new_actions.append(action)
+                new_values = np.maximum(new_values, beliefs.dot(alpha))
+                pending = pending[new_values[pending] < values[pending]]
+            alphas, actions = np.array(new_alphas), np.array(new_actions)
+            change = (new_values - values).max()
+            values = new_values
+            if change < self.epsilon:
+                break
+        logger.info("Solved %d beliefs with %d alpha vectors after %d iterations", N, len(alphas), iteration + 1)
+        return AlphaVectorPolicy(alphas, actions)
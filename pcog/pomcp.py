@@ -0,0 +1,148 @@
+"""
+Partially Observable Monte Carlo Planning in Python.
+
+Works with any model that offers the AI-Toolbox generative interface
+(`getS`, `getA`, `getDiscount` and `sampleSOR`), such as `SparseModel`.
+Mirrors `POMDP.POMCPModel` from AI-Toolbox: particles are sampled from the belief,
+simulations descend the tree with UCB1 and leave it with a uniformly random rollout.
+As in AI-Toolbox the tree can be kept between decisions by passing the action taken and the observation made.
+
+Unlike AI-Toolbox the search can be given a deadline, after which it stops and returns the best action found so far.
+"""
+import logging
+from math import log, sqrt
+from random import choice, randrange
+from time import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ActionBranch(object):
+    __slots__ = ('value', 'visits', 'children')
+
+    def __init__(self):
+        self.value = 0.0
+        self.visits = 0
+        self.children = {}
+
+
+class BeliefNode(object):
+    __slots__ = ('visits', 'particles', 'children')
+
+    def __init__(self, A, particles=None):
+        self.visits = 0
+        self.particles = [] if particles is None else particles
+        self.children = [ActionBranch() for _ in range(A)]
+
+
+class POMCPModel(object):
+    def __init__(self, model, beliefSize, iterations, exp, deadline=None):
+        """
+        :param beliefSize: Number of particles sampled from the initial belief
+        :param iterations: Number of simulations per decision
+        :param exp: Exploration constant of UCB1
+        :param deadline: Milliseconds a decision may take, or None to always run every simulation.
+        At least one simulation is run whatever the deadline.
+        """
+        self.model = model
+        self.belief_size = beliefSize
+        self.iterations = iterations
+        self.exp = exp
+        self.deadline = deadline
+        # Simulations run by the last decision
+        self.simulations = 0
+        self.S = model.getS()
+        self.A = model.getA()
+        self.graph = None
+
+    def sampleAction(self, *args):
+        """
+        `sampleAction(belief, horizon)` plans from `belief`, a probability for every state.
+        `sampleAction(a, o, horizon)` plans from the subtree reached from the last root by taking `a`
+        and observing `o`, keeping its statistics and only running the simulations it lacks.
+        Both return the best action.
+        """
+        if len(args) == 2:
+            belief, horizon = args
+            self.graph = BeliefNode(self.A, self._sample_belief(belief))
+        else:
+            a, o, horizon = args
+            self.graph = self._descend(a, o)
+        return self._plan(horizon)
+
+    def _sample_belief(self, belief):
+        belief = np.asarray(belief, dtype=np.float64)
+        return np.random.choice(self.S, size=self.belief_size, p=belief / belief.sum()).tolist()
+
+    def _descend(self, a, o):
+        node = self.graph.children[a].children.get(o) if self.graph is not None else None
+        if node is not None and 0 < len(node.particles):
+            return node
+        # The observation was never simulated, so the new particles are found by rejection from the old ones
+        particles = []
+        if self.graph is not None:
+            for _ in xrange(10 * self.belief_size):
+                s1, sampled, r = self.model.sampleSOR(choice(self.graph.particles), a)
+                if sampled == o:
+                    particles.append(s1)
+                    if self.belief_size <= len(particles):
+                        break
+        if len(particles) == 0:
+            particles = self._sample_belief(np.ones(self.S))
+        return BeliefNode(self.A, particles)
+
+    def _plan(self, horizon):
+        start = time()
+        stop = None if self.deadline is None else start + self.deadline / 1000.0
+        self.simulations = 0
+        for _ in xrange(self.iterations - self.graph.visits):
+            if stop is not None and 0 < self.simulations and stop <= time():
+                logger.info("Planning deadline of %d ms reached", self.deadline)
+                break
+            self._simulate(self.graph, choice(self.graph.particles), 0, horizon)
+            self.simulations += 1
+        logger.info("Ran %d simulations in %.0f ms", self.simulations, (time() - start) * 1000.0)
+        return self._best(self.graph)
+
+    @staticmethod
+    def _best(node):
+        values = [child.value for child in node.children]
+        return values.index(max(values))
+
+    def _ucb(self, node):
+        untried = [a for a, child in enumerate(node.children) if child.visits == 0]
+        if untried:
+            return choice(untried)
+        scale = log(node.visits)
+        scores = [child.value + self.exp * sqrt(scale / child.visits) for child in node.children]
+        return scores.index(max(scores))
+
+    def _simulate(self, node, s, depth, horizon):
+        if horizon <= depth:
+            return 0.0
+        node.visits += 1
+        a = self._ucb(node)
+        s1, o, r = self.model.sampleSOR(s, a)
+        action = node.children[a]
+        child = action.children.get(o)
+        if child is None:
+            action.children[o] = BeliefNode(self.A, [s1])
+            future = self._rollout(s1, depth + 1, horizon)
+        else:
+            child.particles.append(s1)
+            future = self._simulate(child, s1, depth + 1, horizon)
+        value = r + self.model.getDiscount() * future
+        action.visits += 1
+        action.value += (value - action.value) / action.visits
+        return value
+
+    def _rollout(self, s, depth, horizon):
+        total, discount = 0.0, 1.0
+        gamma = self.model.getDiscount()
+        for _ in xrange(depth, horizon):
+            s, o, r = self.model.sampleSOR(s, randrange(self.A))
+            total += discount * r
+            discount *= gamma
+        return total
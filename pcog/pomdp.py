@@ -0,0 +1,139 @@
+"""
+A NumPy implementation of the part of the AI-Toolbox POMDP bindings that PCog uses.
+
+`pcog.deps` falls back to this module when the AI-Toolbox shared libraries have not been built,
+so `from .deps import POMDP` keeps working on any machine with NumPy. It provides `Model`,
+`updateBelief` and the sampling planner `POMCPModel`. The exact solvers of AI-Toolbox
+(`IncrementalPruning` and `Policy`) are not part of it.
+"""
+from bisect import bisect_right
+from random import random
+
+import numpy as np
+
+from .pomcp import POMCPModel
+
+__all__ = ['Model', 'POMCPModel', 'updateBelief']
+
+# Tolerance of the check that every distribution sums to one
+TOLERANCE = 1e-6
+
+
+def _stochastic(array, shape, name):
+    array = np.array(array, dtype=np.float64)
+    if array.shape != shape:
+        raise ValueError("{} function must have shape {}, not {}".format(name, shape, array.shape))
+    if np.any(array < 0.0) or np.any(TOLERANCE < np.abs(array.sum(axis=-1) - 1.0)):
+        raise ValueError("{} function contains rows that are not probability distributions".format(name))
+    return array
+
+
+def _cumulative(array):
+    """
+    Cumulative rows as nested lists, so sampling a row is a bisection without any NumPy call overhead.
+    """
+    cumulative = np.cumsum(array, axis=-1)
+    cumulative[..., -1] = 1.0
+    return cumulative.tolist()
+
+
+class Model(object):
+    def __init__(self, O, S, A):
+        """
+        A model where every action keeps the state, the first observation is always made and nothing is rewarded,
+        as in AI-Toolbox.
+        """
+        self.S, self.A, self.O = S, A, O
+        self.discount = 1.0
+        transitions = np.zeros((S, A, S))
+        transitions[np.arange(S), :, np.arange(S)] = 1.0
+        observations = np.zeros((S, A, O))
+        observations[:, :, 0] = 1.0
+        self.setTransitionFunction(transitions)
+        self.setObservationFunction(observations)
+        self.setRewardFunction(np.zeros((S, A, S)))
+
+    def setTransitionFunction(self, transitions):
+        """
+        :param transitions: (S, A, S) nested sequences or array, the probability of every s, a, s1
+        """
+        self.transitions = _stochastic(transitions, (self.S, self.A, self.S), "Transition")
+        self._transition_rows = _cumulative(self.transitions)
+
+    def setObservationFunction(self, observations):
+        """
+        :param observations: (S, A, O) nested sequences or array, the probability of every s1, a, o
+        """
+        self.observations = _stochastic(observations, (self.S, self.A, self.O), "Observation")
+        self._observation_rows = _cumulative(self.observations)
+
+    def setRewardFunction(self, rewards):
+        """
+        :param rewards: (S, A, S) nested sequences or array, the reward of every s, a, s1,
+        or (S, A) expected rewards that do not depend on the arrival state
+        """
+        rewards = np.array(rewards, dtype=np.float64)
+        if rewards.shape not in ((self.S, self.A, self.S), (self.S, self.A)):
+            raise ValueError("Reward function must have shape {} or {}, not {}".format(
+                (self.S, self.A, self.S), (self.S, self.A), rewards.shape))
+        self.rewards = rewards
+        self._reward_rows = rewards.tolist()
+
+    def setDiscount(self, discount):
+        self.discount = discount
+
+    def getDiscount(self):
+        return self.discount
+
+    def getS(self):
+        return self.S
+
+    def getA(self):
+        return self.A
+
+    def getO(self):
+        return self.O
+
+    def getTransitionProbability(self, s, a, s1):
+        return self.transitions[s, a, s1]
+
+    def getObservationProbability(self, s1, a, o):
+        return self.observations[s1, a, o]
+
+    def getExpectedReward(self, s, a, s1):
+        return self.rewards[s, a, s1] if self.rewards.ndim == 3 else self.rewards[s, a]
+
+    def getTransitionFunction(self):
+        return self.transitions
+
+    def getObservationFunction(self):
+        return self.observations
+
+    def getRewardFunction(self):
+        return self.rewards
+
+    def sampleSOR(self, s, a):
+        """
+        Samples an arrival state, an observation and a reward for taking `a` in `s`.
+        """
+        s1 = bisect_right(self._transition_rows[s][a], random())
+        o = bisect_right(self._observation_rows[s1][a], random())
+        reward = self._reward_rows[s][a]
+        return s1, o, reward[s1] if self.rewards.ndim == 3 else reward
+
+    def update_belief(self, belief, a, o):
+        """
+        The belief after taking `a` and observing `o`.
+        `belief` may also be an (N, S) array of beliefs, which are all updated at once.
+        A belief that cannot produce `o` is left unnormalised at zero.
+        """
+        updated = np.dot(belief, self.transitions[:, a, :]) * self.observations[:, a, o]
+        totals = updated.sum(axis=-1, keepdims=True)
+        return np.divide(updated, totals, out=np.zeros_like(updated), where=0.0 < totals)
+
+
+def updateBelief(model, belief, a, o):
+    """
+    Same as `AIToolbox::POMDP::updateBelief`, for this module's models and `SparseModel`.
+    """
+    return model.update_belief(belief, a, o)
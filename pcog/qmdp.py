@@ -0,0 +1,102 @@
+"""
+QMDP and the fast informed bound.
+
+Both value the model as if its state would become known after the next step, QMDP completely and
+the fast informed bound only through the next observation, so the values are upper bounds that
+are found by value iteration over states instead of beliefs. Every action keeps one alpha vector,
+its Q values, so acting on a belief costs one matrix-vector product.
+
+The values are good whenever the belief is close to certain, so `entropy` is provided to decide
+when they can be trusted over a planner that reasons about uncertainty.
+"""
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .pbvi import AlphaVectorPolicy, model_matrices
+
+logger = logging.getLogger(__name__)
+
+
+def entropy(belief):
+    """
+    Entropy of `belief` in bits.
+    """
+    belief = np.asarray(belief, dtype=np.float64)
+    support = belief[0.0 < belief]
+    return float(-(support * np.log2(support)).sum())
+
+
+def _joint(transitions, observations):
+    """
+    An (S * O, S) matrix with the probability of every start state and observation, as row s * O + o,
+    reaching every arrival state.
+    """
+    S, O = observations.shape
+    arrivals = transitions.tocoo()
+    observations = observations.tocsr()
+    # Every transition is repeated once for every observation its arrival state can make
+    counts = np.diff(observations.indptr)[arrivals.col]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.repeat(observations.indptr[arrivals.col], counts) + offsets
+    rows = np.repeat(arrivals.row, counts) * O + observations.indices[positions]
+    columns = np.repeat(arrivals.col, counts)
+    data = np.repeat(arrivals.data, counts) * observations.data[positions]
+    return csr_matrix((data, (rows, columns)), shape=(S * O, S))
+
+
+class QMDP(object):
+    def __init__(self, iterations=1000, epsilon=1e-6):
+        """
+        :param iterations: Maximum number of value iteration sweeps
+        :param epsilon: The values are converged once no Q value changes more than this in a sweep
+        """
+        self.iterations = iterations
+        self.epsilon = epsilon
+
+    def __call__(self, model):
+        return self.solve(model)
+
+    def _sweep(self, q, transitions, observations, rewards, discount):
+        values = q.max(axis=1)
+        return rewards + discount * np.stack([t.dot(values) for t in transitions], axis=1)
+
+    def _prepare(self, transitions, observations):
+        return transitions, observations
+
+    def q_values(self, model):
+        """
+        (S, A) value of taking each action in each state.
+        """
+        transitions, observations, rewards = model_matrices(model)
+        transitions, observations = self._prepare(transitions, observations)
+        discount = model.getDiscount()
+        q = np.zeros(rewards.shape)
+        for iteration in range(self.iterations):
+            updated = self._sweep(q, transitions, observations, rewards, discount)
+            change = np.abs(updated - q).max()
+            q = updated
+            if change < self.epsilon:
+                break
+        logger.info("%s values converged to %g after %d sweeps", type(self).__name__, change, iteration + 1)
+        return q
+
+    def solve(self, model):
+        # type: (...) -> AlphaVectorPolicy
+        q = self.q_values(model)
+        return AlphaVectorPolicy(q.T.copy(), np.arange(q.shape[1]))
+
+
+class FIB(QMDP):
+    """
+    The fast informed bound, which is tighter than QMDP because each observation picks its own best action.
+    """
+    def _prepare(self, transitions, observations):
+        return [_joint(t, o) for t, o in zip(transitions, observations)], observations
+
+    def _sweep(self, q, joints, observations, rewards, discount):
+        S, A = q.shape
+        # The best action after every observation, weighted by the probability of the observation
+        future = [joint.dot(q).max(axis=1).reshape(S, -1).sum(axis=1) for joint in joints]
+        return rewards + discount * np.stack(future, axis=1)
@@ -0,0 +1,130 @@
+"""
+Sparse POMDP models.
+
+Transition and observation functions are kept as one CSR matrix per action, so memory and the work
+of a belief update or a simulated step scale with the number of non-zero probabilities instead of S^2.
+Rewards are an (S, A) matrix of expected rewards, which is all that USM and the planners need since
+the learnt rewards ignore the arrival state.
+
+The model exposes the same accessors as an AI-Toolbox `POMDP.Model` (`getS`, `sampleSOR`, ...)
+so the planners in this package can use either.
+"""
+from bisect import bisect_right
+from random import random
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def row_sampler(matrix):
+    """
+    The rows of a CSR matrix as cumulative probabilities in plain lists, for `sample_row`.
+    """
+    matrix.sort_indices()
+    cumulative = np.cumsum(matrix.data)
+    return matrix.indptr.tolist(), matrix.indices.tolist(), cumulative.tolist()
+
+
+def sample_row(sampler, row):
+    """
+    Samples a column of `row` with probability proportional to its value, by bisection.
+    """
+    indptr, indices, cumulative = sampler
+    start, end = indptr[row], indptr[row + 1]
+    base = cumulative[start - 1] if 0 < start else 0.0
+    position = bisect_right(cumulative, base + random() * (cumulative[end - 1] - base), start, end)
+    return indices[min(position, end - 1)]
+
+
+class SparseModel(object):
+    def __init__(self, transitions, observations, rewards, discount=1.0):
+        """
+        :param transitions: A list with an (S, S) matrix per action, rows are start states
+        :param observations: A list with an (S, O) matrix per action, rows are arrival states
+        :param rewards: (S, A) expected reward of taking each action in each state
+        """
+        self.transitions = [csr_matrix(t, dtype=np.float64) for t in transitions]
+        self.observations = [csr_matrix(o, dtype=np.float64) for o in observations]
+        self.rewards = np.asarray(rewards, dtype=np.float64)
+        self.discount = discount
+        self.S, self.O = self.observations[0].shape
+        self.A = len(self.transitions)
+        if self.rewards.shape != (self.S, self.A):
+            raise ValueError("Rewards must be an (S, A) matrix")
+        # Column access for belief updates
+        self._observation_columns = [o.tocsc() for o in self.observations]
+        # Cumulative probabilities in plain lists so that sampling a row is a bisection
+        self._transition_samplers = [row_sampler(t) for t in self.transitions]
+        self._observation_samplers = [row_sampler(o) for o in self.observations]
+        self._reward_rows = self.rewards.tolist()
+
+    @classmethod
+    def from_dense(cls, transitions, observations, rewards, discount=1.0):
+        """
+        Builds a model from (S, A, S) transitions, (S, A, O) observations and rewards
+        that are either (S, A) or (S, A, S). Arrival state rewards are reduced to their expectation.
+        """
+        transitions = np.asarray(transitions, dtype=np.float64)
+        observations = np.asarray(observations, dtype=np.float64)
+        rewards = np.asarray(rewards, dtype=np.float64)
+        if rewards.ndim == 3:
+            rewards = (transitions * rewards).sum(axis=2)
+        A = transitions.shape[1]
+        return cls([transitions[:, a, :] for a in range(A)],
+                   [observations[:, a, :] for a in range(A)],
+                   rewards,
+                   discount)
+
+    def getS(self):
+        return self.S
+
+    def getA(self):
+        return self.A
+
+    def getO(self):
+        return self.O
+
+    def getDiscount(self):
+        return self.discount
+
+    def setDiscount(self, discount):
+        self.discount = discount
+
+    def getTransitionProbability(self, s, a, s1):
+        return self.transitions[a][s, s1]
+
+    def getObservationProbability(self, s1, a, o):
+        return self.observations[a][s1, o]
+
+    def getExpectedReward(self, s, a, s1):
+        return self._reward_rows[s][a]
+
+    def sampleSOR(self, s, a):
+        """
+        Samples an arrival state, an observation and a reward for taking `a` in `s`.
+        """
+        s1 = sample_row(self._transition_samplers[a], s)
+        o = sample_row(self._observation_samplers[a], s1)
+        return s1, o, self._reward_rows[s][a]
+
+    def update_belief(self, belief, a, o):
+        """
+        The belief after taking `a` and observing `o`, in O(non-zeros of action `a`).
+        A belief that cannot produce `o` is left unnormalised at zero.
+        """
+        predicted = self.transitions[a].T.dot(np.asarray(belief, dtype=np.float64))
+        column = self._observation_columns[a][:, o].toarray().ravel()
+        updated = predicted * column
+        total = updated.sum()
+        if 0.0 < total:
+            updated /= total
+        return updated
+
+    def to_dense(self):
+        """
+        (S, A, S) transitions, (S, A, O) observations and (S, A, S) rewards for dense backends.
+        """
+        transitions = np.stack([t.toarray() for t in self.transitions], axis=1)
+        observations = np.stack([o.toarray() for o in self.observations], axis=1)
+        rewards = np.repeat(self.rewards[:, :, np.newaxis], self.S, axis=2)
+        return transitions, observations, rewards
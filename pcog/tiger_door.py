@@ -3,6 +3,7 @@
 import time
 from deps import MDP
 from deps import POMDP
+from pbvi import PBVI
 
 # RENDERING
 
@@ -187,16 +188,22 @@ def tiger_door_simulation():
     horizon = 15
     # The 0.0 is the epsilon factor, used with high horizons. It gives a way
     # to stop the computation if the policy has converged to something static.
-    solver = POMDP.IncrementalPruning(horizon, 0.0)
-
-    # Solve the model. After this line, the problem has been completely
-    # solved. All that remains is setting up an experiment and see what
-    # happens!
-    solution = solver(model)
-
-    # We create a policy from the solution, in order to obtain actual actions
-    # depending on what happens in the environment.
-    policy = POMDP.Policy(2, 3, 2, solution[1])
+    # Without AI-Toolbox there is no exact solver, so the point-based solver
+    # stands in for it and its policy acts on the belief updated every step.
+    exact = hasattr(POMDP, 'IncrementalPruning')
+    if exact:
+        solver = POMDP.IncrementalPruning(horizon, 0.0)
+
+        # Solve the model. After this line, the problem has been completely
+        # solved. All that remains is setting up an experiment and see what
+        # happens!
+        solution = solver(model)
+
+        # We create a policy from the solution, in order to obtain actual actions
+        # depending on what happens in the environment.
+        policy = POMDP.Policy(2, 3, 2, solution[1])
+    else:
+        policy = PBVI()(model)
 
     # We begin a simulation, we start from a uniform belief, which means that
     # we have no idea on which side the tiger is in. We sample from the belief
@@ -207,7 +214,10 @@ def tiger_door_simulation():
     s = 0
 
     # The first thing that happens is that we take an action, so we sample it now.
-    a, ID = policy.sampleAction(b, horizon)
+    if exact:
+        a, ID = policy.sampleAction(b, horizon)
+    else:
+        a = policy.sampleAction(b)
 
     # Setup cout to pretty print the simulation.
     # std::cout.setf(std::ios::fixed, std::ios::floatfield)
@@ -273,7 +283,9 @@ def tiger_door_simulation():
         # computed from a piecewise linear and convex value function, so
         # ranges of similar beliefs actually result in needing to do the same
         # thing (since they are similar enough for the timesteps considered).
-        if t > policy.getH():
+        if not exact:
+            a = policy.sampleAction(b)
+        elif t > policy.getH():
             a, ID = policy.sampleAction(b, policy.getH())
         else:
             a, ID = policy.sampleAction(ID, o, t)
@@ -1,6 +1,9 @@
 from collections import deque, defaultdict
+from itertools import islice
 from random import randint
+import gc
 from scipy.stats import ks_2samp
+import numpy as np
 import sys
 
 EPSILON = 0.000000001
@@ -41,38 +44,382 @@ class USMStats(object):
         pass
 
 class Instance(object):
+    """
+    A single action, observation and reward experienced by the agent.
+    Once it is inserted into a memory an instance becomes a view onto a row of that memory's
+    InstanceLog and its neighbouring rows are its predecessor and successor.
+    """
+    __slots__ = ('_log', '_index', '_action', '_observation', '_reward', '_tree_node')
+
     def __init__(self, action, observation, reward):
-        self.action = action
-        self.observation = observation
-        self.reward = reward
+        self._log = None
+        self._index = None
+        self._action = action
+        self._observation = observation
+        self._reward = reward
         self._tree_node = None
-        self.next = None
-        self.previous = None
 
+    def __getstate__(self):
+        return self._log, self._index, self._action, self._observation, self._reward, self._tree_node
 
-    def usm_nodes(self):
-        act, obs = ActionNode(self.action), ObservationNode(self.observation)
-        act.add_instance(self)
-        obs.add_instance(self)
-        return act, obs
-    
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Instances pickled before they were stored in an InstanceLog
+            state = (None, None, state['action'], state['observation'], state['reward'], state['_tree_node'])
+        self._log, self._index, self._action, self._observation, self._reward, self._tree_node = state
 
-    def get_node(self):
-        return self._tree_node
+    @property
+    def action(self):
+        if self._log is None:
+            return self._action
+        return self._log.action(self._index)
 
+    @property
+    def observation(self):
+        if self._log is None:
+            return self._observation
+        return self._log.observation(self._index)
 
-    def set_node(self, usm_node):
-        self._tree_node = usm_node
+    @property
+    def reward(self):
+        if self._log is None:
+            return self._reward
+        return self._log.reward(self._index)
+
+    @property
+    def next(self):
+        if self._log is None:
+            return None
+        return self._log.instance(self._index + 1)
 
+    @property
+    def previous(self):
+        if self._log is None:
+            return None
+        return self._log.instance(self._index - 1)
 
-    def add_front(self, instance):
-        self.next = instance
-        instance.previous = self
+    def get_node(self):
+        if self._log is None:
+            return self._tree_node
+        return self._log.node(self._index)
+
+    def set_node(self, usm_node):
+        if self._log is None:
+            self._tree_node = usm_node
+        else:
+            self._log.set_node(self._index, usm_node)
 
     def eql_i(self, that):
-        return (isinstance(that, Instance)
-            and self.observation == that.observation
-            and self.action      == that.action)
+        if not isinstance(that, Instance):
+            return False
+        if self._log is not None and self._log is that._log:
+            return self._log.same_percept(self._index, that._index)
+        return (self.observation == that.observation
+                and self.action  == that.action)
+
+
+class LiveInstances(object):
+    """
+    The instances viewing the live rows of an `InstanceLog`, oldest first, as a read only sequence.
+    Indexing and slicing cost the size of the result rather than the number of instances.
+    """
+    __slots__ = ('_log',)
+
+    def __init__(self, log):
+        self._log = log
+
+    def __len__(self):
+        return self._log.size
+
+    def _start(self):
+        return self._log.offset - self._log._base
+
+    def __iter__(self):
+        start = self._start()
+        return islice(self._log.views, start, start + self._log.size)
+
+    def __getitem__(self, key):
+        size = self._log.size
+        if isinstance(key, slice):
+            begin, end, step = key.indices(size)
+            if step < 0:
+                return list(self)[key]
+            start = self._start()
+            return self._log.views[start + begin:start + max(begin, end):step]
+        if key < 0:
+            key += size
+        if not 0 <= key < size:
+            raise IndexError("Instance index out of range")
+        return self._log.views[self._start() + key]
+
+
+class InstanceLog(object):
+    """
+    Column store for the instances of a Utile Suffix Memory.
+    Actions and observations are interned to integer ids, rewards and the ids of the nodes
+    instances are assigned to are kept in arrays and the ordering of instances is their row order.
+    Rows are addressed by an index that counts every instance ever appended,
+    so that rows keep their index when the oldest rows are evicted.
+
+    The ids of the nodes each instance has been added to are kept in compressed rows
+    once the instance has left the insertion window and can gain no more nodes.
+    The instances viewing the rows are kept in `views`, a list aligned with the rows of the arrays,
+    and `live` is the sequence of the ones that have not been evicted.
+    """
+    def __init__(self, node_table, capacity=64):
+        self.node_table = node_table
+        self.offset = 0
+        self.size = 0
+        # Index of the first row held in the arrays, rows before offset have been evicted
+        self._base = 0
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.observations = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float64)
+        self.nodes = np.full(capacity, -1, dtype=np.int32)
+        self.action_values = []
+        self.observation_values = []
+        self._action_ids = {}
+        self._observation_ids = {}
+        self.views = []
+        self.live = LiveInstances(self)
+        self.member_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.member_nodes = np.zeros(4 * capacity, dtype=np.int32)
+        self.settled = 0
+        self._recent_members = deque()
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        self._compact()
+        state = self.__dict__.copy()
+        for column in ('actions', 'observations', 'rewards', 'nodes'):
+            state[column] = state[column][:self.size].copy()
+        state['member_offsets'] = self.member_offsets[:self.settled + 1].copy()
+        state['member_nodes'] = self.member_nodes[:self.member_offsets[self.settled]].copy()
+        del state['live']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.live = LiveInstances(self)
+
+    def end(self):
+        return self.offset + self.size
+
+    def _row(self, index):
+        return index - self._base
+
+    def _used(self):
+        return self.offset - self._base + self.size
+
+    def intern_action(self, action):
+        action_id = self._action_ids.get(action)
+        if action_id is None:
+            action_id = self._action_ids[action] = len(self.action_values)
+            self.action_values.append(action)
+        return action_id
+
+    def intern_observation(self, observation):
+        observation_id = self._observation_ids.get(observation)
+        if observation_id is None:
+            observation_id = self._observation_ids[observation] = len(self.observation_values)
+            self.observation_values.append(observation)
+        return observation_id
+
+    @staticmethod
+    def _grown(column, length, fill=0):
+        if length <= len(column):
+            return column
+        grown = np.full(max(length, 2 * len(column)), fill, dtype=column.dtype)
+        grown[:len(column)] = column
+        return grown
+
+    def append(self, instance):
+        """
+        Stores a detached instance at the end of the log and turns it into a view of its row.
+        """
+        row = self._used()
+        self.actions = self._grown(self.actions, row + 1)
+        self.observations = self._grown(self.observations, row + 1)
+        self.rewards = self._grown(self.rewards, row + 1)
+        self.nodes = self._grown(self.nodes, row + 1, -1)
+        self.actions[row] = self.intern_action(instance._action)
+        self.observations[row] = self.intern_observation(instance._observation)
+        self.rewards[row] = instance._reward
+        self.nodes[row] = -1
+        self.size += 1
+        instance._log = self
+        instance._index = self._base + row
+        instance._action = instance._observation = instance._reward = instance._tree_node = None
+        self.views.append(instance)
+        self._recent_members.append([])
+        return instance
+
+    def extend(self, instances):
+        """
+        Appends detached instances in one step, as `append` does for each of them.
+        """
+        row, count = self._used(), len(instances)
+        self.actions = self._grown(self.actions, row + count)
+        self.observations = self._grown(self.observations, row + count)
+        self.rewards = self._grown(self.rewards, row + count)
+        self.nodes = self._grown(self.nodes, row + count, -1)
+        self.actions[row:row + count] = [self.intern_action(i._action) for i in instances]
+        self.observations[row:row + count] = [self.intern_observation(i._observation) for i in instances]
+        self.rewards[row:row + count] = [i._reward for i in instances]
+        self.nodes[row:row + count] = -1
+        self.size += count
+        for index, instance in enumerate(instances, self._base + row):
+            instance._log = self
+            instance._index = index
+            instance._action = instance._observation = instance._reward = instance._tree_node = None
+        self.views.extend(instances)
+        self._recent_members.extend([[] for _ in instances])
+
+    def instance(self, index):
+        if 0 <= index - self.offset < self.size:
+            return self.views[self._row(index)]
+        return None
+
+    def action(self, index):
+        return self.action_values[self.actions[self._row(index)]]
+
+    def observation(self, index):
+        return self.observation_values[self.observations[self._row(index)]]
+
+    def reward(self, index):
+        return float(self.rewards[self._row(index)])
+
+    def percept(self, index):
+        row = self._row(index)
+        return int(self.actions[row]), int(self.observations[row])
+
+    def same_percept(self, index, other):
+        row, other_row = self._row(index), self._row(other)
+        return (self.actions[row] == self.actions[other_row]
+                and self.observations[row] == self.observations[other_row])
+
+    def node(self, index):
+        node_id = self.nodes[self._row(index)]
+        if node_id < 0:
+            return None
+        return self.node_table[node_id]
+
+    def set_node(self, index, node):
+        self.nodes[self._row(index)] = node.id
+
+    def column(self, name):
+        """
+        The live rows of the 'actions', 'observations', 'rewards' or 'nodes' column, oldest first.
+        """
+        start = self.offset - self._base
+        return getattr(self, name)[start:start + self.size]
+
+    def membership_arrays(self):
+        """
+        Every membership of a live instance as two arrays, the position of the instance
+        in `column` order and the id of the node holding it.
+        """
+        dead = self.offset - self._base
+        start, end = self.member_offsets[dead], self.member_offsets[self.settled]
+        positions = [np.repeat(np.arange(self.settled - dead), np.diff(self.member_offsets[dead:self.settled + 1]))]
+        nodes = [self.member_nodes[start:end]]
+        for position, members in enumerate(self._recent_members, self.settled - dead):
+            positions.append(np.full(len(members), position, dtype=np.int64))
+            nodes.append(np.array(members, dtype=np.int32))
+        return np.concatenate(positions), np.concatenate(nodes)
+
+    def memberships(self, index):
+        """
+        Ids of the nodes holding the instance at `index`. For an instance still in the insertion window
+        this is the list that new memberships are appended to.
+        """
+        row = self._row(index)
+        if row < self.settled:
+            return self.member_nodes[self.member_offsets[row]:self.member_offsets[row + 1]].tolist()
+        return self._recent_members[row - self.settled]
+
+    def settle(self, index):
+        """
+        Moves the memberships of every instance before `index` into the compressed rows.
+        """
+        row = min(self._row(index), self._used())
+        while self.settled < row:
+            members = self._recent_members.popleft()
+            start = self.member_offsets[self.settled]
+            self.member_offsets = self._grown(self.member_offsets, self.settled + 2)
+            self.member_nodes = self._grown(self.member_nodes, start + len(members))
+            self.member_nodes[start:start + len(members)] = members
+            self.settled += 1
+            self.member_offsets[self.settled] = start + len(members)
+
+    def reset_memberships(self, memberships):
+        """
+        Replaces every membership with `memberships`, a list of node ids per row.
+        """
+        self._compact()
+        self.member_offsets = np.zeros(self.size + 1, dtype=np.int64)
+        self.member_nodes = np.zeros(0, dtype=np.int32)
+        self.settled = 0
+        self._recent_members = deque(memberships)
+
+    def evict(self):
+        """
+        Drops the oldest row. The instance viewing it becomes detached and keeps its values.
+        """
+        self.settle(self.offset + 1)
+        row = self._row(self.offset)
+        instance = self.views[row]
+        # The slot is reclaimed when the arrays are compacted
+        self.views[row] = None
+        instance._action = instance.action
+        instance._observation = instance.observation
+        instance._reward = instance.reward
+        instance._log = instance._index = None
+        self.offset += 1
+        self.size -= 1
+        if self.size < self.offset - self._base:
+            self._compact()
+        return instance
+
+    def copy(self, node_table):
+        """
+        A copy of the log that looks nodes up in `node_table` and whose rows are viewed by new instances.
+        """
+        log = InstanceLog.__new__(InstanceLog)
+        log.__dict__.update(self.__dict__)
+        log.node_table = node_table
+        for column in ('actions', 'observations', 'rewards', 'nodes', 'member_offsets', 'member_nodes'):
+            setattr(log, column, getattr(self, column).copy())
+        log.action_values = list(self.action_values)
+        log.observation_values = list(self.observation_values)
+        log._action_ids = dict(self._action_ids)
+        log._observation_ids = dict(self._observation_ids)
+        log._recent_members = deque([list(members) for members in self._recent_members])
+        log.live = LiveInstances(log)
+        log.views = [None] * (self.offset - self._base)
+        for index in xrange(self.offset, self.end()):
+            view = Instance(None, None, None)
+            view._log, view._index = log, index
+            log.views.append(view)
+        return log
+
+    def _compact(self):
+        """
+        Moves the live rows to the start of the arrays.
+        """
+        dead = self.offset - self._base
+        if dead == 0:
+            return
+        for column in (self.actions, self.observations, self.rewards, self.nodes):
+            column[:self.size] = column[dead:dead + self.size]
+        start, end = self.member_offsets[dead], self.member_offsets[self.settled]
+        self.member_nodes[:end - start] = self.member_nodes[start:end]
+        self.member_offsets[:self.settled - dead + 1] = self.member_offsets[dead:self.settled + 1] - start
+        self.settled -= dead
+        del self.views[:dead]
+        self._base = self.offset
 
 
 class USMNode(object):
@@ -80,7 +427,13 @@ class USMNode(object):
         self.is_fringe = False
         self.children = {}
         self.instances = []
+        self.reward_total = 0.0
         self.parent = None
+        self.id = None
+        # Counts of (action, observation) pairs for instances assigned to this node
+        self.observation_counts = {}
+        # Counts of the ids of the nodes assigned to the successors of this node's instances
+        self.transition_counts = {}
 
     def __str__(self):
         return "r"
@@ -95,8 +448,64 @@ class USMNode(object):
         child_node.parent = self
         self.children[key] = child_node
 
-    def add_instance(self, instance):
+    def copy(self, instances):
+        """
+        A copy of this node holding `instances`. The children and parent are left for the caller to replace.
+        """
+        node = self.__class__.__new__(self.__class__)
+        node.__dict__.update(self.__dict__)
+        node.children = dict(self.children)
+        node.instances = instances
+        node.observation_counts = dict([(action, dict(counts))
+                                        for action, counts in self.observation_counts.items()])
+        node.transition_counts = dict(self.transition_counts)
+        return node
+
+    def remove_child(self, key):
+        child_node = self.children.pop(key)
+        child_node.parent = None
+        return child_node
+
+    def add_instance(self, instance, reward=None):
         self.instances.append(instance)
+        self.reward_total += instance.reward if reward is None else reward
+
+    def remove_instance(self, instance):
+        # Instances are evicted oldest first so they are usually at the front
+        if self.instances[0] is instance:
+            del self.instances[0]
+        else:
+            self.instances.remove(instance)
+        if len(self.instances) == 0:
+            self.reward_total = 0.0
+        else:
+            self.reward_total -= instance.reward
+
+    def count_observation(self, action, observation, delta=1):
+        counts = self.observation_counts.setdefault(action, {})
+        counts[observation] = counts.get(observation, 0) + delta
+        if counts[observation] == 0:
+            del counts[observation]
+            if len(counts) == 0:
+                del self.observation_counts[action]
+
+    def count_transition(self, successor_node, delta=1):
+        count = self.transition_counts.get(successor_node.id, 0) + delta
+        if count == 0:
+            del self.transition_counts[successor_node.id]
+        else:
+            self.transition_counts[successor_node.id] = count
+
+    def observation_total(self, action):
+        counts = self.observation_counts.get(action)
+        if counts is None:
+            return 0
+        return sum(counts.values())
+
+    def reset_statistics(self):
+        self.reward_total = sum([i.reward for i in self.instances], 0.0)
+        self.observation_counts = {}
+        self.transition_counts = {}
 
     def is_leaf(self):
         if self.is_fringe: 
@@ -124,9 +533,12 @@ class ActionNode(USMNode):
     def __str__(self):
         return "{}".format(self.action)
 
+    def key(self):
+        return self.action
+
     def _instances_reward(self, action):
         if self.action == action:
-            return sum([i.reward for i in self.instances])
+            return self.reward_total
         else:
             return 0.0
 
@@ -147,6 +559,9 @@ class ObservationNode(USMNode):
     def __str__(self):
         return "{}".format(self.observation)
 
+    def key(self):
+        return self.observation
+
     def action(self, a):
         return self.child(a)
 
@@ -154,21 +569,313 @@ class ObservationNode(USMNode):
         return self.parent._reward(total_reward, instances, action)
 
 
+class UtilityCache(object):
+    """
+    Reward totals and instance counts summed along the path from the root to every node of a memory.
+    They are kept in arrays indexed by node id and interned action id, from which the reward of any node
+    for every action is read. Only the rows of touched nodes and their descendants are recomputed.
+    """
+    def __init__(self, touched=()):
+        self.parents = np.zeros(0, dtype=np.int32)
+        self.depths = np.zeros(0, dtype=np.int32)
+        self.actions = np.zeros(0, dtype=np.int32)
+        self.own_rewards = np.zeros(0, dtype=np.float64)
+        self.own_counts = np.zeros(0, dtype=np.int64)
+        self.rewards = np.zeros((0, 0), dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.touched = set(touched)
+
+    def _reserve(self, size, width):
+        self.parents = InstanceLog._grown(self.parents, size, -1)
+        self.depths = InstanceLog._grown(self.depths, size, -1)
+        self.actions = InstanceLog._grown(self.actions, size, -1)
+        self.own_rewards = InstanceLog._grown(self.own_rewards, size)
+        self.own_counts = InstanceLog._grown(self.own_counts, size)
+        self.counts = InstanceLog._grown(self.counts, size)
+        rows, columns = self.rewards.shape
+        if rows < size or columns < width:
+            rewards = np.zeros((max(size, 2 * rows), max(width, columns)), dtype=np.float64)
+            rewards[:rows, :columns] = self.rewards
+            self.rewards = rewards
+
+    def _read_node(self, node_id, node, action_ids):
+        if node is None:
+            self.parents[node_id] = self.depths[node_id] = self.actions[node_id] = -1
+            self.own_rewards[node_id] = self.own_counts[node_id] = 0
+            return
+        depth, current = 0, node
+        while current.parent is not None:
+            depth, current = depth + 1, current.parent
+        self.depths[node_id] = depth
+        self.parents[node_id] = node.parent.id if node.parent is not None else -1
+        if isinstance(node, ActionNode):
+            self.actions[node_id] = action_ids[node.action]
+            self.own_rewards[node_id] = node.reward_total
+            self.own_counts[node_id] = len(node.instances)
+        else:
+            self.actions[node_id] = -1
+            self.own_rewards[node_id] = self.own_counts[node_id] = 0
+
+    def refresh(self, node_table, action_ids):
+        """
+        Recomputes the rows of the touched nodes and of every node below them.
+        """
+        size = len(node_table)
+        self._reserve(size, len(action_ids))
+        if len(self.touched) == 0:
+            return
+        dirty = np.zeros(size, dtype=np.bool_)
+        for node_id in self.touched:
+            self._read_node(node_id, node_table[node_id], action_ids)
+            dirty[node_id] = True
+        self.touched.clear()
+        depths = self.depths[:size]
+        for depth in xrange(depths.max() + 1):
+            level = np.flatnonzero(depths == depth)
+            if 0 < depth:
+                dirty[level] |= dirty[self.parents[level]]
+            rows = level[dirty[level]]
+            if len(rows) == 0:
+                continue
+            if 0 < depth:
+                self.rewards[rows] = self.rewards[self.parents[rows]]
+                self.counts[rows] = self.counts[self.parents[rows]] + self.own_counts[rows]
+            else:
+                self.rewards[rows] = 0.0
+                self.counts[rows] = self.own_counts[rows]
+            labelled = rows[0 <= self.actions[rows]]
+            self.rewards[labelled, self.actions[labelled]] += self.own_rewards[labelled]
+
+    def leaves(self, size):
+        """
+        Ids of the nodes without children.
+        """
+        depths, parents = self.depths[:size], self.parents[:size]
+        has_children = np.zeros(size, dtype=np.bool_)
+        has_children[parents[0 < depths]] = True
+        return np.flatnonzero((0 <= depths) & ~has_children)
+
+    def rewards_of(self, node_ids, columns):
+        """
+        The mean reward of each node for each action column, None columns are actions never taken.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        rewards = np.zeros((len(node_ids), len(columns)), dtype=np.float64)
+        known = [j for j, column in enumerate(columns) if column is not None]
+        rewards[:, known] = self.rewards[node_ids][:, [columns[j] for j in known]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return rewards / self.counts[node_ids][:, np.newaxis]
+
+
 class UtileSuffixMemory(object):
     def __init__(self,
                  window_size=4,
                  fringe_depth=2,
                  gamma=0.3,
                  known_actions=None,
-                 known_observations=None):
+                 known_observations=None,
+                 max_instances=None):
+        """
+        :param max_instances: When set only the most recent `max_instances` instances are kept.
+        Older instances are evicted along with their contribution to the statistics of the tree.
+        """
+        if max_instances is not None and max_instances < window_size:
+            raise ValueError("A memory must keep at least window_size instances")
+        # Changes whenever nodes, states, fringe flags or the set of leaves holding assigned instances change,
+        # which is everything that `traverse` depends on
+        self.version = 0
         self._root = USMNode()
-        self.instances = []
+        self._node_table = []
+        self._free_ids = []
+        self._log = InstanceLog(self._node_table)
+        self._register(self._root)
         self._states = set()
+        # Maps the (action, observation) suffix that precedes each state to the states that carry it
+        self._fringe_index = {}
+        self._fringe_keys = {}
         self.window_size = window_size
         self.fringe_depth = fringe_depth
         self.gamma = gamma
         self._action_space = known_actions
         self._observation_space = known_observations
+        self.max_instances = max_instances
+        # Built on first use
+        self._utilities = None
+        # Ids of the nodes whose statistics changed since `take_changes` was last called
+        self._changed = set()
+
+    @property
+    def instances(self):
+        return self._log.live
+
+    @property
+    def instance_log(self):
+        return self._log
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_changed', set())
+        self.__dict__.setdefault('version', 0)
+        if '_log' not in state:
+            self._restore_instance_log(self.__dict__.pop('instances'))
+
+    def _restore_instance_log(self, instances):
+        """
+        Moves the instances of a memory pickled before the InstanceLog existed into a new log.
+        """
+        self._node_table = []
+        self._free_ids = []
+        self.max_instances = None
+        self._utilities = None
+        self._log = InstanceLog(self._node_table)
+        for node in self._walk_nodes():
+            self._register(node)
+        for i in instances:
+            node = i.get_node()
+            self._log.append(i)
+            if node is not None:
+                i.set_node(node)
+        self._reindex()
+
+    def _register(self, node):
+        self.version += 1
+        if 0 < len(self._free_ids):
+            node.id = self._free_ids.pop()
+            self._node_table[node.id] = node
+        else:
+            node.id = len(self._node_table)
+            self._node_table.append(node)
+
+    def _release(self, node):
+        self.version += 1
+        self._touch(node.id)
+        self._node_table[node.id] = None
+        self._free_ids.append(node.id)
+        node.id = None
+
+    def _walk_nodes(self):
+        stack = [self._root]
+        while 0 < len(stack):
+            node = stack.pop()
+            yield node
+            stack.extend(node.get_children())
+
+    def _reindex(self):
+        """
+        Rebuilds the statistics that are maintained incrementally by `insert`
+        from the instance lists of the nodes and the instance log.
+        """
+        states = self._states
+        self._states = set()
+        self._fringe_index = {}
+        self._fringe_keys = {}
+        for state in states:
+            self._add_state(state)
+        memberships = [[] for _ in self.instances]
+        for node in self._walk_nodes():
+            node.reset_statistics()
+            for i in node.instances:
+                memberships[i._index - self._log.offset].append(node.id)
+        self._log.reset_memberships(memberships)
+        self._log.settle(self._log.end() - self.window_size + 1)
+        self.version += 1
+        for i in self.instances:
+            node = i.get_node()
+            if node is not None:
+                node.count_observation(i.action, i.observation)
+        for node in self._walk_nodes():
+            if isinstance(node, ActionNode):
+                for i in node.instances:
+                    successor = i.next
+                    if successor is not None and successor.get_node() is not None:
+                        node.count_transition(successor.get_node())
+
+    def _action_nodes(self, instance):
+        return [node for node in map(self._node_table.__getitem__, self._log.memberships(instance._index))
+                if isinstance(node, ActionNode)]
+
+    def _assign_node(self, instance, node):
+        """
+        Associates an instance with the state it was inserted into,
+        keeping the observation counts of the old and new nodes correct
+        along with the transition counts of the action nodes holding its predecessor.
+        """
+        previous_node = instance.get_node()
+        if previous_node is not None:
+            previous_node.count_observation(instance.action, instance.observation, -1)
+            self._changed.add(previous_node.id)
+            if 0 == len(previous_node.observation_counts):
+                self.version += 1
+        if 0 == len(node.observation_counts):
+            self.version += 1
+        node.count_observation(instance.action, instance.observation)
+        self._changed.add(node.id)
+        instance.set_node(node)
+        if instance.previous is not None:
+            for action_node in self._action_nodes(instance.previous):
+                if previous_node is not None:
+                    action_node.count_transition(previous_node, -1)
+                action_node.count_transition(node)
+                self._changed.add(action_node.id)
+
+    def _touch(self, node_id):
+        self._changed.add(node_id)
+        if self._utilities is not None:
+            self._utilities.touched.add(node_id)
+
+    def take_changes(self):
+        """
+        The ids of the nodes whose instances or statistics changed since the last call.
+        """
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def _suffix_key(self, instances):
+        return tuple([self._log.percept(i._index) for i in instances])
+
+    def _state_key(self, state):
+        """
+        The `fringe_depth` instances that lead back from the first instance of a state.
+        Shorter when the instance history runs out first.
+        """
+        chain = []
+        instance = state.instances[0] if 0 < len(state.instances) else None
+        while instance is not None and len(chain) < self.fringe_depth:
+            chain.append(instance)
+            instance = instance.previous
+        return self._suffix_key(chain)
+
+    def _add_state(self, state):
+        if state in self._states:
+            return
+        self.version += 1
+        self._states.add(state)
+        key = self._state_key(state)
+        self._fringe_keys[state] = key
+        self._fringe_index.setdefault(key, set()).add(state)
+
+    def _rekey_state(self, state):
+        """
+        Moves a state to the fringe index entry of its current key.
+        """
+        key = self._state_key(state)
+        old_key = self._fringe_keys[state]
+        if key != old_key:
+            states = self._fringe_index[old_key]
+            states.remove(state)
+            if len(states) == 0:
+                del self._fringe_index[old_key]
+            self._fringe_keys[state] = key
+            self._fringe_index.setdefault(key, set()).add(state)
+
+    def _remove_state(self, state):
+        self.version += 1
+        self._states.remove(state)
+        key = self._fringe_keys.pop(state)
+        states = self._fringe_index[key]
+        states.remove(state)
+        if len(states) == 0:
+            del self._fringe_index[key]
 
     def _correct_fringe(self, node):
         """
@@ -179,46 +886,185 @@ class UtileSuffixMemory(object):
         """
         assert(not node.is_fringe)
         while node is not self._root:
+            if node.is_fringe:
+                self.version += 1
+                self._changed.add(node.id)
             node.set_fringe(False)
             node = node.parent
             if node is not self._root:
                 # If the node was a leaf node before the fringe insertion
                 # we should remove it since it's no longer a valid state
                 if node in self._states:
-                    self._states.remove(node)
+                    self._remove_state(node)
 
     def insert(self, instance):
-        if instance in self.instances:
+        if instance._log is not None:
             raise ValueError("Inserting an instance that has already been used")
-        if 0 < len(self.instances): # Add new instance to end of instance linked list
-            self.instances[-1].add_front(instance)
-        self.instances.append(instance)
-        state = self._insert()
+        # Appending to the log makes the new instance the successor of the last one
+        self._log.append(instance)
+        state = self._insert_suffix(self._decode(self.instances[-self.window_size:]))
+        while self.max_instances is not None and self.max_instances < len(self._log):
+            self._evict_oldest()
+        return state
+
+    def insert_many(self, instances):
+        """
+        Inserts `instances` in order and returns the state of the last one.
+        The memory ends up exactly as if they had been inserted one at a time, but the instances are
+        appended to the log together and each is decoded once for all of the suffixes it is part of.
+        """
+        instances = list(instances)
+        if len(instances) == 0:
+            return None
+        if self.max_instances is not None:
+            # Evictions have to happen between the insertions
+            for instance in instances:
+                state = self.insert(instance)
+            return state
+        if (any([instance._log is not None for instance in instances])
+                or len(set(map(id, instances))) < len(instances)):
+            raise ValueError("Inserting an instance that has already been used")
+        # Nodes are only ever created here so collecting garbage during the batch is wasted work
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._log.extend(instances)
+            views = self.instances
+            start = len(views) - len(instances)
+            first = max(0, start - self.window_size + 1)
+            decoded = self._decode(views[first:])
+            for end in xrange(start - first + 1, len(decoded) + 1):
+                state = self._insert_suffix(decoded[max(0, end - self.window_size):end])
+        finally:
+            if enabled:
+                gc.enable()
+        return state
+
+    def _decode(self, instances):
+        return [(i, i.action, i.observation, i.reward) for i in instances]
+
+    def _insert_suffix(self, suffix):
+        """
+        Inserts the newest instance of `suffix`, a list of (instance, action, observation, reward)
+        ending with the instance, into the tree and the fringe and assigns it to its state.
+        """
+        instance = suffix[-1][0]
+        # Pair every instance with the node of its successor, the newest has not been assigned one yet
+        successor_nodes = [i.get_node() for i, a, o, r in suffix[1:]] + [None]
+        suffix = [percept + (node,) for percept, node in zip(suffix, successor_nodes)]
+        state = self._insert_leaf(suffix)
+        self._insert_fringe(suffix)
         if state.is_leaf():
-            self._states.add(state)
+            self._add_state(state)
             self._correct_fringe(state)
-        instance.set_node(state)
+        self._assign_node(instance, state)
+        # Older instances can no longer be added to nodes by later insertions
+        self._log.settle(instance._index - self.window_size + 2)
         return state
 
-    def _insert_instances(self, start_node, instances, fringe=False):
+    def _evict_oldest(self):
+        """
+        Removes the oldest instance from every node it was added to and
+        subtracts it from the reward, transition and observation statistics.
+        Nodes that are left without instances, children or assigned instances are pruned and
+        the states whose fringe key started at or led back to the instance are re-keyed.
+        """
+        instance = self.instances[0]
+        # States holding the instance or one of the instances whose fringe key reaches back to it
+        rekeyed = set()
+        for i in self.instances[:self.fringe_depth]:
+            rekeyed.update(self._log.memberships(i._index))
+        successor = instance.next
+        successor_node = successor.get_node() if successor is not None else None
+        touched = []
+        for node_id in self._log.memberships(instance._index):
+            node = self._node_table[node_id]
+            node.remove_instance(instance)
+            self._touch(node_id)
+            if successor_node is not None and isinstance(node, ActionNode):
+                node.count_transition(successor_node, -1)
+            touched.append(node)
+        node = instance.get_node()
+        if node is not None:
+            node.count_observation(instance.action, instance.observation, -1)
+            self._changed.add(node.id)
+            if 0 == len(node.observation_counts):
+                self.version += 1
+            touched.append(node)
+        self._log.evict()
+        for node in touched:
+            self._prune(node)
+        for node in map(self._node_table.__getitem__, rekeyed):
+            if node is not None and node in self._states:
+                self._rekey_state(node)
+
+    @staticmethod
+    def _holds_instances(node):
+        """
+        Whether instances are still added to or assigned to a node. Eviction can empty the instances
+        of a leaf while newer instances remain assigned to it.
+        """
+        return 0 < len(node.instances) or 0 < len(node.observation_counts)
+
+    def _prune(self, node):
+        while (node.id is not None
+               and node is not self._root
+               and not self._holds_instances(node)
+               and len(node.children) == 0):
+            parent = node.parent
+            parent.remove_child(node.key())
+            if node in self._states:
+                self._remove_state(node)
+            self._release(node)
+            node = parent
+        # A parent that lost its last non-fringe child becomes a state
+        if (node.id is not None
+                and node is not self._root
+                and self._holds_instances(node)
+                and node.is_leaf()
+                and node not in self._states):
+            self._add_state(node)
+
+    def _insert_instances(self, start_node, percepts, fringe=False):
+        """
+        Walks down from `start_node` along `percepts`, creating missing nodes, and adds every
+        instance to the action and observation node it reaches.
+        The percepts are (instance, action, observation, reward, node of the successor).
+        """
         current = start_node
-        for i in instances:
-            action, observation = i.usm_nodes()
-            action.set_fringe(fringe)
-            observation.set_fringe(fringe)
-            if i.action in current.children:
-                current = current.children[action.action]
-                current.add_instance(i)
-            else:
-                current.children[action.action] = action
-                current.add_child(action.action, action)
-                current = action
-            if i.observation in current.children:
-                current = current.children[observation.observation]
-                current.add_instance(i)
-            else:
-                current.add_child(observation.observation, observation)
-                current = observation
+        touched = self._utilities.touched if self._utilities is not None else None
+        changed = self._changed
+        for i, a, o, r, successor_node in percepts:
+            members = self._log.memberships(i._index)
+            action = current.children.get(a)
+            if action is None:
+                action = ActionNode(a)
+                action.set_fringe(fringe)
+                self._register(action)
+                current.add_child(a, action)
+            action.add_instance(i, r)
+            members.append(action.id)
+            if len(action.instances) == 1 and action in self._states:
+                # A state emptied by eviction is keyed by its new first instance
+                self._rekey_state(action)
+            if successor_node is not None:
+                action.count_transition(successor_node)
+            observation = action.children.get(o)
+            if observation is None:
+                observation = ObservationNode(o)
+                observation.set_fringe(fringe)
+                self._register(observation)
+                action.add_child(o, observation)
+            observation.add_instance(i, r)
+            members.append(observation.id)
+            if len(observation.instances) == 1 and observation in self._states:
+                self._rekey_state(observation)
+            changed.add(action.id)
+            changed.add(observation.id)
+            if touched is not None:
+                touched.add(action.id)
+                touched.add(observation.id)
+            current = observation
         return current
 
     def _insert_leaf(self, suffix):
@@ -227,25 +1073,14 @@ class UtileSuffixMemory(object):
     def _insert_fringe(self, suffix):
         presuffix = suffix[0:self.fringe_depth]
         post_suffix = suffix[self.fringe_depth:]
-        for state in self._states:
-            # Match prefix of the suffix with the suffix of each state
-            # If we can do the match then add the instance suffix to the fringe
-            # With the suffix node as root
-            count = 0
-            instance = state.instances[0]
-            equal = True
-            while equal and instance and count < self.fringe_depth:
-                equal = instance.eql_i(presuffix[count])
-                instance = instance.previous
-                count += 1
-            if equal:
+        # Match prefix of the suffix with the suffix of each state
+        # If we can do the match then add the instance suffix to the fringe
+        # With the suffix node as root
+        # States whose history is shorter than the fringe depth match on a shorter prefix
+        key = self._suffix_key([percept[0] for percept in presuffix])
+        for length in range(1, len(key) + 1):
+            for state in self._fringe_index.get(key[:length], ()):
                 self._insert_instances(state, post_suffix, True)
-    
-    def _insert(self):
-        suffix = self.instances[-self.window_size:]
-        leaf = self._insert_leaf(suffix)
-        self._insert_fringe(suffix)
-        return leaf
 
     def has_actions(self):
         return 0 < len(self._action_space)
@@ -265,15 +1100,34 @@ class UtileSuffixMemory(object):
     def get_root(self):
         return self._root
 
+    def node(self, node_id):
+        return self._node_table[node_id]
+
     def get_instances(self):
         return self.instances
 
     def utility(self, state):
         # type: (UtileSuffixMemory, USMNode) -> float
-        best = -sys.maxint
-        for action in self.get_actions():
-            best = max(state.reward(action), best)
-        return best
+        if len(self.get_actions()) == 0:
+            return -sys.maxint
+        return float(self.utility_matrix([state]).max())
+
+    def utility_matrix(self, nodes):
+        """
+        The reward of every node in `nodes` for every action, a row per node and a column per action
+        in the order of `get_actions`. Rows are served from a cache that is only recomputed for the
+        paths touched since it was last read.
+        """
+        return self._utility_cache().rewards_of([node.id for node in nodes], self._utility_columns())
+
+    def _utility_cache(self):
+        if self._utilities is None:
+            self._utilities = UtilityCache(touched=[node.id for node in self._walk_nodes()])
+        self._utilities.refresh(self._node_table, self._log._action_ids)
+        return self._utilities
+
+    def _utility_columns(self):
+        return [self._log._action_ids.get(action) for action in self.get_actions()]
 
     def tree_leaves(self):
         # BFS of the tree for all leaves
@@ -297,20 +1151,25 @@ class UtileSuffixMemory(object):
         If the two distributions are sufficiently different then the state space is expanded to include all leaf nodes
         currently in the tree. The distribution comparison is performed using a KS test.
         """
-        all_leaves = self.tree_leaves()
-        all_leaves_dist = list(map(lambda leaf: self.utility(leaf), all_leaves))
-        print(all_leaves_dist)
-        current_leaves = self.get_states()
-        current_dist = list(map(lambda leaf: self.utility(leaf), current_leaves))
-        print(current_dist)
-        D, p_value = test_result = ks_2samp(all_leaves_dist, current_dist)
-        print(D)
-        print(p_value)
+        cache = self._utility_cache()
+        all_leaves = cache.leaves(len(self._node_table))
+        current_leaves = np.array([state.id for state in self.get_states()], dtype=np.int64)
+        utilities = cache.rewards_of(np.concatenate([all_leaves, current_leaves]),
+                                     self._utility_columns()).max(axis=1)
+        all_leaves_dist = utilities[:len(all_leaves)]
+        current_dist = utilities[len(all_leaves):]
+        D, p_value = ks_2samp(all_leaves_dist, current_dist)
         if p_value < alpha or alpha < D:
-            for leaf in all_leaves:
-                if leaf.is_fringe:
-                    leaf.set_fringe(False)
-                    self._correct_fringe(leaf)
+            self.version += 1
+            promoted = [leaf for leaf in map(self._node_table.__getitem__, all_leaves) if leaf.is_fringe]
+            for leaf in promoted:
+                self._changed.add(leaf.id)
+                leaf.set_fringe(False)
+                self._correct_fringe(leaf)
+            # The promoted leaves replace their ancestors as states
+            for leaf in promoted:
+                if leaf.is_leaf():
+                    self._add_state(leaf)
             return True
         else:
             return False
@@ -322,33 +1181,49 @@ class UtileSuffixMemory(object):
             return []
 
     def traverse(self, instances):
+        node, is_leaf = self._traverse_to(instances)
+        return [node] if is_leaf else self._leaves(node)
+
+    def _traverse_to(self, instances):
+        """
+        The node that `traverse` stops at and whether it is the leaf reached, rather than a node
+        whose instances lead to the leaves.
+        """
         if len(instances) < 1:
             raise ValueError("You cannot traverse the tree with empty instances")
         current = self.get_root()
         for i in instances:
             if current.is_leaf():
-                return [current]
+                return current, True
             if i.action in current.children:
                 current = current.children[i.action]
             else:
-                return self._leaves(current.parent)
+                return current.parent, False
             if i.observation in current.children:
                 current = current.children[i.observation]
             else:
-                return self._leaves(current)
-        if current.is_leaf():
-            return [current]
-        else:
-            return self._leaves(current)
+                return current, False
+        return current, current.is_leaf()
 
     def _tau(self, state, action):
-        instances = []         
+        """
+        Action nodes for `action` on the path from `state` to the root.
+        The instances they hold are the experiences of taking `action` from `state`.
+        """
+        nodes = []
         current = state
         while current is not self._root:
             if isinstance(current, ActionNode) and current.action == action:
-                instances += current.instances
+                nodes.append(current)
             current = current.parent
-        return instances
+        return nodes
+
+    def _successor_counts(self, state, action):
+        counts = defaultdict(int)
+        for node in self._tau(state, action):
+            for successor, count in node.transition_counts.items():
+                counts[successor] += count
+        return counts
 
     def transition_for(self, incident_state, action):
         """
@@ -359,36 +1234,15 @@ class UtileSuffixMemory(object):
         :param action: Action that we are considering
         :return: Array which represents a probability distribution - always sums to 1
         """
-        l = len(self.get_states())
-        transitions = [None for _ in range(l)]
-        tau = self._tau(incident_state, action)
-        idx = 0
-        leaf_count = 0.0
-        for i in tau:
-            if i.next and i.next.get_node().is_leaf():
-                leaf_count += 1.0
+        # Since some instances may be associated with internal nodes it actually makes sense to only
+        # consider instances that map to a leaf node which is a another state
+        counts = self._successor_counts(incident_state, action)
+        leaf_count = float(sum([count for successor, count in counts.items()
+                                if self._node_table[successor].is_leaf()]))
         if leaf_count <= 0.0:
-            for idx, state in enumerate(self.get_states()):
-                if state is incident_state:
-                    transitions[idx] = 1.0
-                else:
-                    transitions[idx] = 0.0
-            return transitions
-        for arrival_state in self.get_states():
-            equal_count = 0.0
-            for i in tau:
-                """
-                Within _tau there are two possibilities:
-                arrival_state is equal to the leaf of the successor instance to the instance
-                It is not
-                Since some instances may be associated with internal nodes it actually makes sense to only
-                consider instances that map to a leaf node which is a another state
-                """
-                if i.next and i.next.get_node().is_leaf():
-                    if i.next.get_node() is arrival_state:
-                        equal_count += 1.0
-            transitions[idx] = equal_count / leaf_count
-            idx += 1
+            return [1.0 if state is incident_state else 0.0 for state in self.get_states()]
+        transitions = [counts.get(state.id, 0) / leaf_count if state.is_leaf() else 0.0
+                       for state in self.get_states()]
         x = sum(transitions)
         if abs(x - 1.0) >= EPSILON:
             raise ValueError("Transition function is not close enough to one")
@@ -403,49 +1257,33 @@ class UtileSuffixMemory(object):
         ```
         """
         tau = self._tau(s1, action)
-        if len(tau) == 0:
+        experiences = sum([len(node.instances) for node in tau])
+        if experiences == 0:
             return 1.0 / float(len(self.get_states()))
-        total = 0.0
-        count = 0.0
-        for i in tau:
-            if i.next and i.next.get_node().is_leaf():
-                count += 1.0
-                if i.next.get_node() is s2:
-                    total += 1.0
-        return total / float(len(tau))
+        if not s2.is_leaf():
+            return 0.0
+        total = sum([node.transition_counts.get(s2.id, 0) for node in tau])
+        return total / float(experiences)
 
     def observation_fn(self, state, action, observation):
         if len(self.instances) == 0:
             raise ValueError("Attempted to find the observation function on USM with no instances")
-        count = 0.0
-        observed_count = 0.0
-        for i in self.instances:
-            if action == i.action and i.get_node() is state:
-                observed_count += 1.0
-                if i.observation == observation:
-                    count += 1.0
-        if observed_count == 0.0:
+        observed_count = state.observation_total(action)
+        if observed_count == 0:
             return 1.0 / float(len(self.get_observations()))
-        return count / observed_count
+        return state.observation_counts[action].get(observation, 0) / float(observed_count)
 
     def observation_for(self, state, action):
-        observations = [None for _ in self.get_observations()]
-        total_possible = 0.0
-        for i in self.instances:
-            if i.get_node() is state and i.action == action:
-                total_possible += 1.0
+        total_possible = float(state.observation_total(action))
         # Handle edge case where there is no state or action recorded for this observation
         # Also handles cases where the sum of the distribution does not add up to zero
         # Hacky I know :(
         if total_possible == 0.0:
             p = 1.0 / len(self.get_observations())
             return normalise_to_one([p for _ in self.get_observations()])
-        for idx, observation in enumerate(self.get_observations()):
-            observation_count = 0.0
-            for i in self.instances:
-                if i.observation == observation and i.get_node() is state and i.action == action:
-                    observation_count += 1.0
-            observations[idx] = observation_count / total_possible
+        counts = state.observation_counts[action]
+        observations = [counts.get(observation, 0) / total_possible
+                        for observation in self.get_observations()]
         x = sum(observations)
         if EPSILON <= abs(x - 1.0):
             raise ValueError("Observation function distribution is not close enough to one")
@@ -468,17 +1306,51 @@ class UtileSuffixMemory(object):
             result += " ".join(map(str, level)) + "\n"
         return result
 
-    def derive_new(self, memodict={}):
-        usm = UtileSuffixMemory(
-            window_size=self.window_size,
-            gamma=self.gamma,
-            known_actions=self.get_actions(),
-            known_observations=self.get_observations(),
-        )
-        for i in self.get_instances():
-            usm.insert(Instance(
-                action=i.action,
-                observation=i.observation,
-                reward=i.reward
-            ))
+    def save(self, path):
+        """
+        Writes the whole memory to `path` in the binary snapshot format of `pcog.usm_store`.
+        """
+        from .usm_store import save_usm
+        save_usm(self, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Restores a memory written by `save`. The instance columns are memory-mapped from the file.
+        """
+        from .usm_store import load_usm
+        return load_usm(path)
+
+    def derive_new(self):
+        """
+        Copies the memory with all of its parameters, nodes and instances.
+        The node graph and the instance log are copied directly instead of replaying every insertion
+        so this takes time linear in the size of the tree.
+        """
+        usm = UtileSuffixMemory.__new__(UtileSuffixMemory)
+        usm.__dict__.update(self.__dict__)
+        usm._utilities = None
+        usm._changed = set()
+        usm._node_table = table = [None] * len(self._node_table)
+        usm._log = self._log.copy(table)
+        log = usm._log
+        for node in self._node_table:
+            if node is not None:
+                table[node.id] = node.copy([log.instance(i._index) for i in node.instances])
+        for node in table:
+            if node is not None:
+                if node.parent is not None:
+                    node.parent = table[node.parent.id]
+                for key, child in node.children.items():
+                    node.children[key] = table[child.id]
+        usm._root = table[self._root.id]
+        usm._free_ids = list(self._free_ids)
+        usm._states = set([table[state.id] for state in self._states])
+        usm._fringe_keys = dict([(table[state.id], key) for state, key in self._fringe_keys.items()])
+        usm._fringe_index = dict([(key, set([table[state.id] for state in states]))
+                                  for key, states in self._fringe_index.items()])
+        if self._action_space is not None:
+            usm._action_space = list(self._action_space)
+        if self._observation_space is not None:
+            usm._observation_space = list(self._observation_space)
         return usm
@@ -1,8 +1,15 @@
 import logging
+from collections import defaultdict
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
 
 from .deps import MDP
 from .deps import POMDP
-from .usm import UtileSuffixMemory
+from .usm import UtileSuffixMemory, ActionNode, EPSILON
+from .sparse_model import SparseModel
+from .pomcp import POMCPModel
+from .diagnostics import DiagnosticsSink, describe
 from .usm_draw import draw_usm
 from typing import List
 import pickle
@@ -61,20 +68,483 @@ def reward_function(usm):
     return rewards
 
 
-def belief_state(usm, past_perceptions):
-    leaves = usm.traverse(past_perceptions)
-    if len(leaves) == 0:
-        # Edge case for when we don't find any related leaves (IE we have like one step that matches nothing )
-        logger.info("Belief state could not be derived for: %s", str(past_perceptions))
-        p = 1.0 / float(len(usm.get_states()))
-        return [p for _ in usm.get_states()]
-    else:
-        p = 1.0 / float(len(leaves))
-    belief = [0.0 for _ in usm.get_states()]
-    for idx, state in enumerate(usm.get_states()):
-        if state in leaves:
-            belief[idx] = p
-    return belief
+def _lookup(keys, values, size, default=-1):
+    """
+    Array mapping each of `keys` to the matching entry of `values` and everything else below `size` to `default`.
+    """
+    table = np.full(size, default, dtype=np.int64)
+    table[np.asarray(keys, dtype=np.int64)] = values
+    return table
+
+
+def _normalise_rows(counts, empty_row, message):
+    """
+    Divides each row of `counts` by its total. The last column holds experiences that fall outside of
+    the distribution and rows without any experience are replaced by `empty_row(row index)`.
+    """
+    totals = counts.sum(axis=1)
+    experienced = 0 < totals
+    distribution = np.zeros((counts.shape[0], counts.shape[1] - 1))
+    distribution[experienced] = counts[experienced, :-1] / totals[experienced, np.newaxis]
+    for row in np.flatnonzero(~experienced):
+        distribution[row] = empty_row(row)
+    if np.any(EPSILON <= np.abs(distribution.sum(axis=1) - 1.0)):
+        raise ValueError(message)
+    return distribution
+
+
+def _normalise_sparse_rows(counts, empty_rows, message):
+    """
+    Sparse version of `_normalise_rows`, `empty_rows(rows)` gives the (rows, columns, values)
+    entries that replace rows without any experience.
+    """
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    experienced = 0 < totals
+    scale = np.zeros(len(totals))
+    scale[experienced] = 1.0 / totals[experienced]
+    distribution = coo_matrix(csr_matrix(counts)[:, :-1].multiply(scale[:, np.newaxis]))
+    rows, columns, values = empty_rows(np.flatnonzero(~experienced))
+    distribution = csr_matrix((np.concatenate([distribution.data, values]),
+                               (np.concatenate([distribution.row, rows]),
+                                np.concatenate([distribution.col, columns]))),
+                              shape=(counts.shape[0], counts.shape[1] - 1))
+    if np.any(EPSILON <= np.abs(np.asarray(distribution.sum(axis=1)).ravel() - 1.0)):
+        raise ValueError(message)
+    return distribution
+
+
+def _transition_counts(usm, states):
+    """
+    Sparse (S * A, S + 1) counts of the successors of every state and action, row s * A + a.
+    Successors that are leaves but not in `states` are counted in the last column.
+    Built with one pass over the memberships of the instance log.
+    """
+    if not usm.has_actions():
+        raise ValueError("USM does not have an action space")
+    actions = usm.get_actions()
+    S, A = len(states), len(actions)
+    action_index = dict([(action, a) for a, action in enumerate(actions)])
+    # Rows of the counts and the action nodes whose experiences are summed into them
+    rows, tau = [], []
+    for s, state in enumerate(states):
+        current = state
+        while current is not usm.get_root():
+            if isinstance(current, ActionNode) and current.action in action_index:
+                rows.append(s * A + action_index[current.action])
+                tau.append(current.id)
+            current = current.parent
+    log = usm.instance_log
+    positions, members = log.membership_arrays()
+    assigned = log.column('nodes')
+    successors = np.full(len(assigned), -1, dtype=np.int64)
+    successors[:-1] = assigned[1:]
+    size = 1 + max([members.max() if 0 < len(members) else 0,
+                    assigned.max() if 0 < len(assigned) else 0,
+                    max(tau) if 0 < len(tau) else 0,
+                    max([state.id for state in states]) if 0 < S else 0])
+    tau_nodes = np.unique(tau)
+    slots = _lookup(tau_nodes, np.arange(len(tau_nodes)), size)
+    # Successors that are states land in their column, other leaves in the last column
+    successor_ids = np.unique(successors[0 <= successors])
+    columns = _lookup([state.id for state in states], np.arange(S), size)
+    for successor in successor_ids:
+        if columns[successor] < 0 and usm.node(successor).is_leaf():
+            columns[successor] = S
+    kept = np.flatnonzero(0 <= slots[members])
+    kept = kept[0 <= successors[positions[kept]]]
+    kept_columns = columns[successors[positions[kept]]]
+    experienced = 0 <= kept_columns
+    node_counts = csr_matrix((np.ones(experienced.sum()),
+                              (slots[members[kept]][experienced], kept_columns[experienced])),
+                             shape=(len(tau_nodes), S + 1))
+    # Sums the counts of the action nodes behind each row
+    membership = csr_matrix((np.ones(len(rows)), (np.asarray(rows, dtype=np.int64), slots[np.asarray(tau, dtype=np.int64)])),
+                            shape=(S * A, len(tau_nodes)))
+    return membership.dot(node_counts)
+
+
+def _stay_entries(A):
+    def stay(rows):
+        return rows, rows // A, np.ones(len(rows))
+    return stay
+
+
+def _observation_counts(usm, states):
+    """
+    Sparse (S * A, O + 1) counts of the observations made on arriving in every state with every action,
+    row s * A + a. Observations outside of the observation space are counted in the last column.
+    Built with one pass over the instance log.
+    """
+    if not usm.has_observations():
+        raise ValueError("USM does not have an observation space")
+    actions, observations = usm.get_actions(), usm.get_observations()
+    S, A, O = len(states), len(actions), len(observations)
+    log = usm.instance_log
+    assigned = log.column('nodes')
+    size = 1 + max([state.id for state in states] + [assigned.max() if 0 < len(assigned) else 0])
+    state_of = _lookup([state.id for state in states], np.arange(S), size)[np.maximum(assigned, 0)]
+    state_of[assigned < 0] = -1
+    action_index = dict([(action, a) for a, action in enumerate(actions)])
+    observation_index = dict([(observation, o) for o, observation in enumerate(observations)])
+    action_of = np.array([action_index.get(action, -1) for action in log.action_values] + [-1],
+                         dtype=np.int64)[log.column('actions')]
+    observation_of = np.array([observation_index.get(observation, O) for observation in log.observation_values] + [O],
+                              dtype=np.int64)[log.column('observations')]
+    kept = (0 <= state_of) & (0 <= action_of)
+    return csr_matrix((np.ones(kept.sum()), (state_of[kept] * A + action_of[kept], observation_of[kept])),
+                      shape=(S * A, O + 1))
+
+
+def _uniform_entries(O):
+    def uniform(rows):
+        return np.repeat(rows, O), np.tile(np.arange(O), len(rows)), np.full(len(rows) * O, 1.0 / O)
+    return uniform
+
+
+def transition_tensor(usm, states=None):
+    # type: (UtileSuffixMemory, List) -> np.ndarray
+    """
+    The transition function as an (S, A, S) array, built with one pass over the memberships
+    of the instance log instead of per state and action lookups.
+    Agrees with `UtileSuffixMemory.transition_for` for every state and action.
+    """
+    states = list(usm.get_states()) if states is None else states
+    S, A = len(states), len(usm.get_actions())
+
+    def stay(row):
+        distribution = np.zeros(S)
+        distribution[row // A] = 1.0
+        return distribution
+    return _normalise_rows(_transition_counts(usm, states).toarray(), stay,
+                           "Transition function is not close enough to one").reshape(S, A, S)
+
+
+def observation_tensor(usm, states=None):
+    # type: (UtileSuffixMemory, List) -> np.ndarray
+    """
+    The observation function as an (S, A, O) array, built with one pass over the instance log.
+    Agrees with `UtileSuffixMemory.observation_for` for every state and action.
+    """
+    states = list(usm.get_states()) if states is None else states
+    S, A, O = len(states), len(usm.get_actions()), len(usm.get_observations())
+
+    def uniform(row):
+        return np.full(O, 1.0 / O)
+    return _normalise_rows(_observation_counts(usm, states).toarray(), uniform,
+                           "Observation function distribution is not close enough to one").reshape(S, A, O)
+
+
+def reward_tensor(usm, states=None):
+    # type: (UtileSuffixMemory, List) -> np.ndarray
+    """
+    The reward function as an (S, A, S) array. Rewards only depend on the state and action
+    so the (S, A) rewards read from the memory's utility cache are repeated along the last axis.
+    States without any experience have no reward.
+    """
+    states = list(usm.get_states()) if states is None else states
+    rewards = np.nan_to_num(usm.utility_matrix(states))
+    return np.repeat(rewards[:, :, np.newaxis], len(states), axis=2)
+
+
+def sparse_model(usm, states=None, diagnostics=None):
+    # type: (UtileSuffixMemory, List, DiagnosticsSink) -> SparseModel
+    """
+    The POMDP of a Utile Suffix Memory as a `SparseModel`, without building any dense S x A x S array.
+    :param diagnostics: A `DiagnosticsSink` that the functions of the model are submitted to
+    """
+    states = list(usm.get_states()) if states is None else states
+    A, O = len(usm.get_actions()), len(usm.get_observations())
+    transitions = _normalise_sparse_rows(_transition_counts(usm, states), _stay_entries(A),
+                                         "Transition function is not close enough to one")
+    observations = _normalise_sparse_rows(_observation_counts(usm, states), _uniform_entries(O),
+                                          "Observation function distribution is not close enough to one")
+    rewards = np.nan_to_num(usm.utility_matrix(states))
+    transitions = [transitions[a::A] for a in range(A)]
+    observations = [observations[a::A] for a in range(A)]
+    _record(transitions, observations, rewards, diagnostics)
+    return SparseModel(transitions, observations, rewards, usm.gamma)
+
+
+class IncrementalModel(object):
+    """
+    The POMDP of a memory that is kept between regenerations.
+    `update` only recomputes the (state, action) rows that depend on nodes changed since the last update,
+    so the cost of a regeneration follows the new experience rather than the size of the memory.
+
+    A state keeps its index for as long as it is a state. The indices of states that disappear are retired:
+    they become absorbing states without reward that no other state moves to. Once retired indices
+    outnumber live ones the model is rebuilt with fresh indices.
+    """
+    def __init__(self, usm):
+        # type: (UtileSuffixMemory) -> None
+        self.usm = usm
+        self._reset()
+
+    def _reset(self):
+        # The state node of every index, None once retired
+        self.states = []
+        self.retired = 0
+        self._index = {}
+        self._state_ids = []
+        # Per index and action, the (columns, probabilities) of the transition row
+        self._transitions = []
+        self._observations = []
+        self._rewards = []
+        # Successor ids and counts of every action node on the path of a state, by node id
+        self._node_counts = {}
+        # The same counts as a matrix with a row per node id and a column per successor id
+        self._count_matrix = csr_matrix((0, 0))
+
+    def _empty_rows(self, index):
+        A, O = len(self.usm.get_actions()), len(self.usm.get_observations())
+        self._transitions[index] = [(np.array([index]), np.ones(1)) for _ in range(A)]
+        self._observations[index] = np.full((A, O), 1.0 / O)
+        self._rewards[index] = np.zeros(A)
+
+    def _states_below(self, node, memo):
+        found = memo.get(node)
+        if found is None:
+            if node in self._index:
+                found = [node]
+            else:
+                found = [state for child in node.get_children() if not child.is_fringe
+                         for state in self._states_below(child, memo)]
+            memo[node] = found
+        return found
+
+    def _counts_of(self, node):
+        counts = self._node_counts.get(node.id)
+        if counts is None:
+            successors = node.transition_counts
+            counts = (np.fromiter(successors.keys(), dtype=np.int64, count=len(successors)),
+                      np.fromiter(successors.values(), dtype=np.float64, count=len(successors)))
+            self._node_counts[node.id] = counts
+        return node.id
+
+    def _transition_rows(self, rows):
+        """
+        Recomputes the transition rows in `rows`, a list of (state, action index) pairs.
+        Every row is the sum of the counts of the action nodes for its action on the path of its state,
+        which is a product of sparse matrices over the cached counts of each node.
+        """
+        usm = self.usm
+        actions = usm.get_actions()
+        size = len(usm._node_table)
+        S = len(self.states)
+        # Action nodes behind every row
+        row_ids, node_ids = [], []
+        for row, (state, a) in enumerate(rows):
+            for node in usm._tau(state, actions[a]):
+                row_ids.append(row)
+                node_ids.append(self._counts_of(node))
+        membership = csr_matrix((np.ones(len(row_ids)), (row_ids, node_ids)), shape=(len(rows), size))
+        ids = sorted(self._node_counts)
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        lengths = np.zeros(size, dtype=np.int64)
+        lengths[ids] = [len(self._node_counts[node_id][0]) for node_id in ids]
+        indptr[1:] = np.cumsum(lengths)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        counts = [self._node_counts[node_id] for node_id in ids] + [empty]
+        self._count_matrix = csr_matrix((np.concatenate([values for successors, values in counts]),
+                                         np.concatenate([successors for successors, values in counts]),
+                                         indptr),
+                                        shape=(size, size))
+        # Successors that are states land in their column, other leaves in the last column
+        successor_ids = np.unique(self._count_matrix.indices)
+        columns = np.full(len(successor_ids), -1, dtype=np.int64)
+        for k, successor in enumerate(successor_ids.tolist()):
+            node = usm.node(successor)
+            if node is not None and node.is_leaf():
+                columns[k] = self._index.get(node, S)
+        kept = 0 <= columns
+        selection = csr_matrix((np.ones(kept.sum()), (successor_ids[kept], columns[kept])), shape=(size, S + 1))
+        totals = membership.dot(self._count_matrix).dot(selection).tocsr()
+        totals.sort_indices()
+        for row, (state, a) in enumerate(rows):
+            start, end = totals.indptr[row], totals.indptr[row + 1]
+            columns, values = totals.indices[start:end], totals.data[start:end]
+            index = self._index[state]
+            if 0 < len(columns) and columns[-1] == S:
+                raise ValueError("Transition function is not close enough to one")
+            total = values.sum()
+            if total <= 0.0:
+                self._transitions[index][a] = (np.array([index]), np.ones(1))
+            else:
+                self._transitions[index][a] = (columns.astype(np.int64), values / total)
+
+    def update(self):
+        # type: () -> int
+        """
+        Brings the model up to date with the memory and returns the number of transition rows recomputed.
+        """
+        usm = self.usm
+        actions = usm.get_actions()
+        action_index = dict([(action, a) for a, action in enumerate(actions)])
+        changed = usm.take_changes()
+        if self.retired > len(self.states) - self.retired or 0 == len(self.states):
+            self._reset()
+            changed = set([node.id for node in usm._walk_nodes()])
+        for node_id in changed:
+            self._node_counts.pop(node_id, None)
+        states = usm.get_states()
+        removed = [state for state in self._index if state not in states]
+        added = [state for state in states if state not in self._index]
+        # Action nodes that counted a node that became or stopped being a state
+        status_ids = [self._state_ids[self._index[state]] for state in removed] + [state.id for state in added]
+        status_ids = [node_id for node_id in status_ids if node_id < self._count_matrix.shape[1]]
+        if 0 < len(status_ids):
+            changed.update(np.unique(self._count_matrix.tocsc()[:, status_ids].indices).tolist())
+        state_rows = set(added)
+        transition_rows = set()
+        for state in removed:
+            index = self._index.pop(state)
+            self.states[index] = None
+            self.retired += 1
+            self._empty_rows(index)
+        for state in added:
+            self._index[state] = len(self.states)
+            self.states.append(state)
+            self._state_ids.append(state.id)
+            self._transitions.append([None] * len(actions))
+            self._observations.append(None)
+            self._rewards.append(None)
+            transition_rows.update([(state, a) for a in range(len(actions))])
+        memo = {}
+        for node_id in changed:
+            node = usm.node(node_id)
+            if node is None or node.is_fringe:
+                continue
+            below = self._states_below(node, memo)
+            state_rows.update(below)
+            if isinstance(node, ActionNode) and node.action in action_index:
+                a = action_index[node.action]
+                transition_rows.update([(state, a) for state in below])
+        transition_rows = list(transition_rows)
+        if 0 < len(transition_rows):
+            self._transition_rows(transition_rows)
+        state_rows = list(state_rows)
+        if 0 < len(state_rows):
+            rewards = np.nan_to_num(usm.utility_matrix(state_rows))
+            for state, reward in zip(state_rows, rewards):
+                index = self._index[state]
+                self._rewards[index] = reward
+                self._observations[index] = np.array([usm.observation_for(state, action) for action in actions])
+        logger.info("Recomputed %d transition rows of %d states", len(transition_rows), len(self.states))
+        return len(transition_rows)
+
+    def transition_matrices(self):
+        """
+        The (S, S) transition matrix of every action.
+        """
+        S = len(self.states)
+        matrices = []
+        for a in range(len(self.usm.get_actions())):
+            rows = [transitions[a] for transitions in self._transitions]
+            indptr = np.zeros(S + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([len(columns) for columns, probabilities in rows])
+            indices = np.concatenate([columns for columns, probabilities in rows] + [np.zeros(0, dtype=np.int64)])
+            data = np.concatenate([probabilities for columns, probabilities in rows] + [np.zeros(0)])
+            matrices.append(csr_matrix((data, indices, indptr), shape=(S, S)))
+        return matrices
+
+    def model(self, sparse=False, diagnostics=None):
+        """
+        The model with the rows computed by the last `update`, a `SparseModel` when `sparse` is set.
+        :param diagnostics: A `DiagnosticsSink` that the functions of the model are submitted to
+        """
+        A, O = len(self.usm.get_actions()), len(self.usm.get_observations())
+        S = len(self.states)
+        transitions = self.transition_matrices()
+        observations = np.array(self._observations).reshape(S, A, O)
+        rewards = np.array(self._rewards).reshape(S, A)
+        if sparse:
+            _record(transitions, observations, rewards, diagnostics)
+            return SparseModel(transitions, [observations[:, a, :] for a in range(A)], rewards, self.usm.gamma)
+        return _dense_model(np.stack([t.toarray() for t in transitions], axis=1),
+                            observations,
+                            np.repeat(rewards[:, :, np.newaxis], S, axis=2),
+                            self.usm.gamma,
+                            diagnostics)
+
+
+def _instances_stamp(node):
+    """
+    Identifies the instances of a node, which are only ever appended or evicted from the front.
+    """
+    if node is None or len(node.instances) == 0:
+        return 0, None, None
+    return len(node.instances), node.instances[0]._index, node.instances[-1]._index
+
+
+class BeliefIndex(object):
+    """
+    Beliefs over the states of a model given the most recent instances.
+    Beliefs are memoised by the (action, observation) pairs of the instances until the version of the memory
+    changes, so repeated decisions only pay for building the key and walking the tree.
+    A belief read from the instances of an internal node is also recomputed once that node gains or loses
+    instances, which does not change the version.
+    Leaves that have been split since the model was built count towards the state they were split from.
+    """
+    def __init__(self, usm, states=None):
+        # type: (UtileSuffixMemory, List) -> None
+        """
+        :param states: The states of the model in the order of its indices, `None` marks retired indices
+        """
+        self.usm = usm
+        self.states = list(usm.get_states()) if states is None else states
+        self._index = dict([(state, idx) for idx, state in enumerate(self.states) if state is not None])
+        self._uniform = None
+        self._version = None
+        self._beliefs = {}
+
+    def belief(self, past_perceptions):
+        # type: (List[Instance]) -> np.ndarray
+        """
+        The belief for `past_perceptions` as a read only array.
+        """
+        if self._version != self.usm.version:
+            self._version = self.usm.version
+            self._beliefs = {}
+        key = tuple([(i.action, i.observation) for i in past_perceptions])
+        node, is_leaf = self.usm._traverse_to(past_perceptions)
+        stamp = None if is_leaf else _instances_stamp(node)
+        memoised = self._beliefs.get(key)
+        if memoised is None or memoised[1] != stamp:
+            leaves = [node] if is_leaf else self.usm._leaves(node)
+            memoised = self._beliefs[key] = (self._belief(past_perceptions, leaves), stamp)
+        return memoised[0]
+
+    def _uniform_belief(self):
+        if self._uniform is None:
+            self._uniform = self._spread(self._index.values())
+        return self._uniform
+
+    def _spread(self, indices):
+        belief = np.zeros(len(self.states))
+        belief[list(indices)] = 1.0 / len(indices)
+        belief.flags.writeable = False
+        return belief
+
+    def _belief(self, past_perceptions, leaves):
+        matched = set()
+        for leaf in leaves:
+            node = leaf
+            while node is not None and node not in self._index:
+                node = node.parent
+            if node is not None:
+                matched.add(self._index[node])
+        if len(matched) == 0:
+            # Edge case for when we don't find any related leaves (IE we have like one step that matches nothing )
+            logger.info("Belief state could not be derived for: %s", str(past_perceptions))
+            return self._uniform_belief()
+        return self._spread(matched)
+
+
+def belief_state(usm, past_perceptions, states=None):
+    """
+    :param states: The states of the model in the order of its indices, `None` marks retired indices
+    """
+    return BeliefIndex(usm, states).belief(past_perceptions).tolist()
 
 
 def _function_sanity_test(func):
@@ -86,37 +556,118 @@ def _function_sanity_test(func):
     return offending
 
 
-def build_pomdp_model(usm, should_draw=False):
-    # type: (UtileSuffixMemory) -> POMDP.Model
+def build_pomdp_model(usm, should_draw=False, transition=None, observation=None, reward=None, sparse=False,
+                      diagnostics=None):
+    # type: (UtileSuffixMemory, bool, np.ndarray, np.ndarray, np.ndarray, bool, DiagnosticsSink) -> POMDP.Model
     """
     Creates a POMDP model from a Utile Suffix Memory
     :param should_draw: Instructs the method to draw the POMDP being constructed
     :param usm: Utile suffix memory to use in POMDP
+    :param transition: (S, A, S) transition array, built with `transition_tensor` when not given
+    :param observation: (S, A, O) observation array, built with `observation_tensor` when not given
+    :param reward: (S, A, S) reward array, built with `reward_tensor` when not given
+    :param sparse: Build a `SparseModel` instead of a dense AI-Toolbox model
+    :param diagnostics: A `DiagnosticsSink` that the functions of the model are submitted to
     :return: POMDP
     """
     if should_draw:
         draw_usm(usm)
-    S = len(usm.get_states())
-    A = len(usm.get_actions())
-    O = len(usm.get_observations())
-    reward = reward_function(usm)
-    transition = transition_function(usm)
-    observation = observation_function(usm)
-    logger.info("Reward function:\n{}".format(reward))
-    logger.info("Transition function:\n{}".format(transition))
-    logger.info("Observation function:\n{}".format(observation))
+    if sparse:
+        return sparse_model(usm, diagnostics=diagnostics)
+    states = list(usm.get_states())
+    if reward is None:
+        reward = reward_tensor(usm, states)
+    if transition is None:
+        transition = transition_tensor(usm, states)
+    if observation is None:
+        observation = observation_tensor(usm, states)
+    return _dense_model(transition, observation, reward, usm.gamma, diagnostics)
+
+
+def _record(transitions, observations, rewards, diagnostics=None):
+    """
+    Logs a summary of the model, leaving the full functions to the diagnostics sink when there is one.
+    """
+    logger.info("Model %s", describe(transitions, observations, rewards))
+    if diagnostics is not None:
+        diagnostics.submit(transitions=transitions, observations=observations, rewards=rewards)
+
+
+def _dense_model(transition, observation, reward, discount, diagnostics=None):
+    S, A, O = np.shape(observation)
+    _record(transition, observation, reward, diagnostics)
     model = POMDP.Model(O, S, A)
-    model.setRewardFunction(reward)
-    model.setTransitionFunction(transition)
-    model.setObservationFunction(observation)
-    model.setDiscount(usm.gamma)
+    # The AI-Toolbox bindings take nested sequences rather than arrays
+    model.setRewardFunction(np.asarray(reward).tolist())
+    model.setTransitionFunction(np.asarray(transition).tolist())
+    model.setObservationFunction(np.asarray(observation).tolist())
+    model.setDiscount(discount)
     return model
 
 
-def solve(usm, model, past_perceptions, belief_nodes=10000, horizon=10, episolon=0.03):
-    solver = POMDP.POMCPModel(model, belief_nodes, 5000, 2.0)
-    beliefs = belief_state(usm, past_perceptions)
-    logger.info("Beliefs: %s", " ".join(map(str, beliefs)))
-    a = solver.sampleAction(beliefs, horizon)
-    return a
+def _pomcp(model, belief_nodes, iterations, deadline=None):
+    # The compiled search cannot be interrupted, so a deadline needs the Python one
+    if isinstance(model, SparseModel) or deadline is not None:
+        return POMCPModel(model, belief_nodes, iterations, 2.0, deadline)
+    return POMDP.POMCPModel(model, belief_nodes, iterations, 2.0)
+
+
+def _search_belief(model, belief, solver):
+    if isinstance(model, SparseModel) or isinstance(solver, POMCPModel):
+        return belief
+    # The AI-Toolbox bindings take sequences rather than arrays
+    return belief.tolist()
+
+
+class SearchPlanner(object):
+    """
+    A POMCP search that is kept for as long as its model.
+    When the newest instance of the memory is the action the planner chose followed by an observation of the model,
+    the search carries on in the subtree of that action and observation instead of starting again from the belief.
+    With a deadline in milliseconds every decision returns the best action found when it expires.
+    """
+    def __init__(self, usm, model, beliefs=None, belief_nodes=10000, iterations=5000, horizon=10, deadline=None):
+        self.usm = usm
+        self.model = model
+        self.beliefs = BeliefIndex(usm) if beliefs is None else beliefs
+        self.horizon = horizon
+        self.solver = _pomcp(model, belief_nodes, iterations, deadline)
+        self._actions = dict([(action, a) for a, action in enumerate(usm.get_actions())])
+        self._observations = dict([(observation, o) for o, observation in enumerate(usm.get_observations())])
+        # The end of the instance log and the action of the last decision
+        self._planned = None
+        self.reused = 0
+
+    def decide(self, past_perceptions):
+        log = self.usm.instance_log
+        latest = self.usm.get_instances()[-1] if 0 < log.end() else None
+        if (latest is not None
+                and self._planned == (log.end() - 1, self._actions.get(latest.action))
+                and latest.observation in self._observations):
+            a = self.solver.sampleAction(self._planned[1], self._observations[latest.observation], self.horizon)
+            self.reused += 1
+        else:
+            belief = self.beliefs.belief(past_perceptions)
+            logger.info("Belief support: %s", " ".join(map(str, np.flatnonzero(belief))))
+            a = self.solver.sampleAction(_search_belief(self.model, belief, self.solver), self.horizon)
+        self._planned = (log.end(), a)
+        return a
+
+
+def solve(usm, model, past_perceptions, belief_nodes=10000, horizon=10, episolon=0.03, beliefs=None, policy=None,
+          deadline=None):
+    """
+    :param beliefs: The `BeliefIndex` of the model, built over the states of `usm` when not given
+    :param policy: A policy solved for the model ahead of time, such as the alpha vectors of `pcog.pbvi`.
+    Without one the model is searched with POMCP.
+    :param deadline: Milliseconds the search may take before it returns the best action found so far
+    """
+    if beliefs is None:
+        beliefs = BeliefIndex(usm)
+    belief = beliefs.belief(past_perceptions)
+    logger.info("Belief support: %s", " ".join(map(str, np.flatnonzero(belief))))
+    if policy is not None:
+        return policy.sampleAction(belief, horizon)
+    solver = _pomcp(model, belief_nodes, 5000, deadline)
+    return solver.sampleAction(_search_belief(model, belief, solver), horizon)
 
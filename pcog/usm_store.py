@@ -0,0 +1,277 @@
+"""
+Binary snapshots of Utile Suffix Memories.
+
+A snapshot is a single file made of a magic string, a small header and a sequence of raw arrays.
+The header holds the parameters and spaces of the memory along with the dtype, shape and offset
+of every array. The node graph is stored as arrays indexed by node id so restoring a memory never
+unpickles an object graph, and the instance columns are memory-mapped copy-on-write.
+"""
+import gc
+import os
+import pickle
+import struct
+from collections import deque
+
+import numpy as np
+
+from .usm import UtileSuffixMemory, InstanceLog, Instance, USMNode, ActionNode, ObservationNode
+
+MAGIC = b"PCOGUSM1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# Values of the node kind array, missing marks ids that are free in the node table
+MISSING, ROOT, ACTION, OBSERVATION = -1, 0, 1, 2
+
+
+def _aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _csr(rows, dtype):
+    """
+    Flattens a list of lists into an offsets array and a values array.
+    """
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(row) for row in rows])
+    values = np.fromiter((value for row in rows for value in row), dtype=dtype, count=offsets[-1])
+    return offsets, values
+
+
+def _rows(offsets, values):
+    offsets, values = offsets.tolist(), values.tolist()
+    return [values[offsets[i]:offsets[i + 1]] for i in xrange(len(offsets) - 1)]
+
+
+def _interner(values, ids):
+    """
+    Copies of an interning table of the log and a function interning into the copies.
+    """
+    values, ids = list(values), dict(ids)
+
+    def intern(value):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+    return values, intern
+
+
+def _node_arrays(usm, intern_action, intern_observation):
+    log = usm._log
+    table = usm._node_table
+    kinds = np.full(len(table), MISSING, dtype=np.int8)
+    parents = np.full(len(table), -1, dtype=np.int32)
+    keys = np.full(len(table), -1, dtype=np.int32)
+    fringe = np.zeros(len(table), dtype=np.bool_)
+    reward_totals = np.zeros(len(table), dtype=np.float64)
+    instances = []
+    observation_counts = []
+    transition_counts = []
+    for node_id, node in enumerate(table):
+        if node is None:
+            instances.append([])
+            continue
+        if isinstance(node, ActionNode):
+            kinds[node_id], keys[node_id] = ACTION, intern_action(node.action)
+        elif isinstance(node, ObservationNode):
+            kinds[node_id], keys[node_id] = OBSERVATION, intern_observation(node.observation)
+        else:
+            kinds[node_id] = ROOT
+        if node.parent is not None:
+            parents[node_id] = node.parent.id
+        fringe[node_id] = node.is_fringe
+        reward_totals[node_id] = node.reward_total
+        instances.append([i._index - log.offset for i in node.instances])
+        for action, counts in node.observation_counts.items():
+            for observation, count in counts.items():
+                observation_counts.append((node_id,
+                                           intern_action(action),
+                                           intern_observation(observation),
+                                           count))
+        for successor, count in node.transition_counts.items():
+            transition_counts.append((node_id, successor, count))
+    instance_offsets, instance_rows = _csr(instances, np.int64)
+    return {
+        'node_kinds': kinds,
+        'node_parents': parents,
+        'node_keys': keys,
+        'node_fringe': fringe,
+        'node_reward_totals': reward_totals,
+        'node_instance_offsets': instance_offsets,
+        'node_instance_rows': instance_rows,
+        'observation_counts': np.array(observation_counts, dtype=np.int64).reshape(-1, 4),
+        'transition_counts': np.array(transition_counts, dtype=np.int64).reshape(-1, 3),
+    }
+
+
+def save_usm(usm, path):
+    # type: (UtileSuffixMemory, str) -> None
+    """
+    Writes a snapshot of `usm` to `path`. The memory itself is left untouched, the live rows
+    are written from where they are and new values are interned into copies of the tables.
+    """
+    log = usm._log
+    action_values, intern_action = _interner(log.action_values, log._action_ids)
+    observation_values, intern_observation = _interner(log.observation_values, log._observation_ids)
+    arrays = _node_arrays(usm, intern_action, intern_observation)
+    # Rows before the offset were evicted but may not have been compacted away yet
+    dead = log.offset - log._base
+    settled_start, settled_end = log.member_offsets[dead], log.member_offsets[log.settled]
+    recent_offsets, recent_nodes = _csr(log._recent_members, np.int32)
+    states = sorted([state.id for state in usm.get_states()])
+    # Fringe keys are tuples of (action id, observation id) pairs, stored flattened
+    key_offsets, key_values = _csr([sum(usm._fringe_keys[usm._node_table[state]], ()) for state in states],
+                                   np.int32)
+    arrays.update({
+        'actions': log.column('actions'),
+        'observations': log.column('observations'),
+        'rewards': log.column('rewards'),
+        'nodes': log.column('nodes'),
+        'member_offsets': log.member_offsets[dead:log.settled + 1] - settled_start,
+        'member_nodes': log.member_nodes[settled_start:settled_end],
+        'recent_member_offsets': recent_offsets,
+        'recent_member_nodes': recent_nodes,
+        'states': np.array(states, dtype=np.int32),
+        'state_key_offsets': key_offsets,
+        'state_key_values': key_values,
+        'free_ids': np.array(usm._free_ids, dtype=np.int32),
+    })
+    header = {
+        'version': FORMAT_VERSION,
+        'window_size': usm.window_size,
+        'fringe_depth': usm.fringe_depth,
+        'gamma': usm.gamma,
+        'max_instances': usm.max_instances,
+        'known_actions': usm._action_space,
+        'known_observations': usm._observation_space,
+        'action_values': action_values,
+        'observation_values': observation_values,
+        'offset': log.offset,
+        'settled': log.settled - dead,
+        'root': usm._root.id,
+        'arrays': [],
+    }
+    position = 0
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        arrays[name] = array
+        header['arrays'].append((name, array.dtype.str, array.shape, position))
+        position = _aligned(position + array.nbytes)
+    encoded_header = pickle.dumps(header, 2)
+    start = _aligned(len(MAGIC) + 8 + len(encoded_header))
+    # The new snapshot replaces the old file only once it is complete,
+    # memories that are still mapping the old file keep reading it
+    partial_path = path + ".partial"
+    with open(partial_path, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(struct.pack('<Q', len(encoded_header)))
+        snapshot.write(encoded_header)
+        for name, dtype, shape, offset in header['arrays']:
+            snapshot.seek(start + offset)
+            snapshot.write(arrays[name].tostring())
+    os.rename(partial_path, path)
+
+
+def _read(path):
+    with open(path, 'rb') as snapshot:
+        if snapshot.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a USM snapshot".format(path))
+        length, = struct.unpack('<Q', snapshot.read(8))
+        header = pickle.loads(snapshot.read(length))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError("Unsupported USM snapshot version {}".format(header['version']))
+    start = _aligned(len(MAGIC) + 8 + length)
+    arrays = {}
+    for name, dtype, shape, offset in header['arrays']:
+        if 0 < np.prod(shape):
+            # Copy on write so the memory can keep changing without touching the snapshot
+            arrays[name] = np.memmap(path, dtype=np.dtype(dtype), mode='c', offset=start + offset, shape=shape)
+        else:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(dtype))
+    return header, arrays
+
+
+def _restore_log(header, arrays, node_table):
+    log = InstanceLog(node_table, capacity=0)
+    log.offset = log._base = header['offset']
+    log.size = len(arrays['actions'])
+    for column in ('actions', 'observations', 'rewards', 'nodes', 'member_offsets', 'member_nodes'):
+        setattr(log, column, arrays[column])
+    log.action_values = list(header['action_values'])
+    log.observation_values = list(header['observation_values'])
+    log._action_ids = dict([(value, i) for i, value in enumerate(log.action_values)])
+    log._observation_ids = dict([(value, i) for i, value in enumerate(log.observation_values)])
+    log.settled = header['settled']
+    log._recent_members = deque(_rows(arrays['recent_member_offsets'], arrays['recent_member_nodes']))
+    for index in xrange(log.offset, log.end()):
+        view = Instance(None, None, None)
+        view._log, view._index = log, index
+        log.views.append(view)
+    return log
+
+
+def load_usm(path):
+    # type: (str) -> UtileSuffixMemory
+    """
+    Restores the memory saved to `path` by `save_usm`.
+    """
+    header, arrays = _read(path)
+    # Every node is created at once and none of them can be garbage yet
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _restore(header, arrays)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _restore(header, arrays):
+    usm = UtileSuffixMemory(window_size=header['window_size'],
+                            fringe_depth=header['fringe_depth'],
+                            gamma=header['gamma'],
+                            known_actions=header['known_actions'],
+                            known_observations=header['known_observations'],
+                            max_instances=header['max_instances'])
+    kinds = arrays['node_kinds'].tolist()
+    usm._node_table = table = [None] * len(kinds)
+    usm._log = log = _restore_log(header, arrays, table)
+    keys = arrays['node_keys'].tolist()
+    fringe = arrays['node_fringe'].tolist()
+    reward_totals = arrays['node_reward_totals'].tolist()
+    instance_rows = _rows(arrays['node_instance_offsets'], arrays['node_instance_rows'])
+    for node_id, kind in enumerate(kinds):
+        if kind == ACTION:
+            node = ActionNode(log.action_values[keys[node_id]])
+        elif kind == OBSERVATION:
+            node = ObservationNode(log.observation_values[keys[node_id]])
+        elif kind == ROOT:
+            node = USMNode()
+        else:
+            continue
+        node.id = node_id
+        node.is_fringe = fringe[node_id]
+        node.reward_total = reward_totals[node_id]
+        node.instances = [log.views[row] for row in instance_rows[node_id]]
+        table[node_id] = node
+    for node_id, parent_id in enumerate(arrays['node_parents'].tolist()):
+        if 0 <= parent_id:
+            node = table[node_id]
+            table[parent_id].add_child(node.key(), node)
+    for node_id, action, observation, count in arrays['observation_counts'].tolist():
+        table[node_id].observation_counts.setdefault(log.action_values[action], {})[
+            log.observation_values[observation]] = count
+    for node_id, successor, count in arrays['transition_counts'].tolist():
+        table[node_id].transition_counts[successor] = count
+    usm._root = table[header['root']]
+    usm._free_ids = arrays['free_ids'].tolist()
+    key_values = _rows(arrays['state_key_offsets'], arrays['state_key_values'])
+    for state_id, values in zip(arrays['states'].tolist(), key_values):
+        state = table[state_id]
+        key = tuple(zip(values[0::2], values[1::2]))
+        usm._states.add(state)
+        usm._fringe_keys[state] = key
+        usm._fringe_index.setdefault(key, set()).add(state)
+    return usm
@@ -1,8 +1,15 @@
 import unittest
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
 from json import loads
 from bunch import bunchify
 from pcog.agent import simulate, GridAgent
-from pcog.envconf import Action
+from pcog.envconf import Action, HealthObservation
+from pcog.factored import ProductBelief
+from pcog.model_cache import GridModelCache
 
 humoid_json = """
 {
@@ -37,15 +44,153 @@ class GridAgentTest(unittest.TestCase):
     def test_construction(self):
         agent = GridAgent()
         agent.derive_model()
-        observation = bunchify({
+        observation = agent.derive_observation(bunchify({
             "position": [2.0, 0.0, 1.0],
             "health": 10.0,
-            "lastWolfPosition": [1.0, 0.0, 1.0],
-            "lastFoodPosition": [10.0, 0.0, 10.0],
-        })
+            "wolf": [1.0, 0.0, 1.0],
+            "food": [10.0, 0.0, 10.0],
+        }))
+        self.assertEqual(observation[:3], ((0, 0), (0, 0), (1, 1)))
         agent.update_belief(observation)
+        humanoid, wolf, food, health = agent.belief.marginals
+        self.assertEqual(np.argmax(humanoid), agent._cell((0, 0)))
+        self.assertEqual(np.argmax(wolf), agent._cell((0, 0)))
+        self.assertEqual(np.argmax(food), agent._cell((1, 1)))
+        # Eating moves the humanoid onto the neighbouring food, which pays more than attacking the wolf
+        self.assertEqual(agent.belief.joint().dot(agent.expected_rewards()).argmax(), Action.EAT)
+        random.seed(0)
+        np.random.seed(0)
         action = agent.plan()
-        self.assertEqual(action, Action.ATTACK)
+        self.assertEqual(action, Action.EAT)
+        self.assertEqual(agent._last_action, action)
+
+    def test_neighbours(self):
+        agent = GridAgent(3, 4)
+        # Neighbours are at most one block apart along both axes, not along either one
+        self.assertTrue(agent._is_neighbour((1, 1), (2, 2)))
+        self.assertTrue(agent._is_neighbour((1, 1), (1, 1)))
+        self.assertFalse(agent._is_neighbour((0, 0), (0, 2)))
+        self.assertFalse(agent._is_neighbour((0, 0), (3, 1)))
+        self.assertFalse(agent._is_neighbour((0, 0), None))
+        coordinates = agent._grid_coordinates()
+        near = agent._neighbours()
+        for a, b in zip(np.random.randint(len(coordinates), size=50), np.random.randint(len(coordinates), size=50)):
+            self.assertEqual(near[a, b], agent._is_neighbour(coordinates[a], coordinates[b]))
+        # The unknown cell neighbours nothing
+        self.assertFalse(near[-1].any() or near[:, -1].any())
+
+    def test_flee_moves_to_a_neighbour(self):
+        agent = GridAgent(3, 3)
+        flee = agent.get_transitions().factors[0].matrices[Action.FLEE]
+        coordinates = agent._grid_coordinates()
+        for cell, coordinate in enumerate(coordinates):
+            self.assertEqual(flee[cell, cell], 0.0)
+            for other, probability in enumerate(flee[cell, :-1]):
+                self.assertEqual(0.0 < probability, cell != other and agent._is_neighbour(coordinate, coordinates[other]))
+        # Fleeing from the unknown cell has nowhere to go
+        self.assertEqual(flee[-1, -1], 1.0)
+
+    def test_cell_clamps_to_the_grid(self):
+        agent = GridAgent(4, 3)
+        self.assertEqual(agent._cell((2, 3)), agent.L - 2)
+        self.assertEqual(agent._cell((3, 4)), agent._cell((2, 3)))
+        self.assertEqual(agent._cell((3, 1)), agent._cell((2, 1)))
+        self.assertEqual(agent._cell(None), agent.L - 1)
+        # A position on the far edge of the world is discretised one block past the grid
+        position, wolf, food, health = agent.derive_observation(bunchify({
+            "position": [agent.grid_width, 0.0, agent.grid_height],
+            "health": 10.0,
+            "wolf": None,
+            "food": None,
+        }))
+        self.assertEqual(agent._cell(position), agent._cell((2, 3)))
+
+    def test_state_space(self):
+        agent = GridAgent(3, 2)
+        space = agent.space
+        states = agent._get_all_states()
+        self.assertEqual(len(states), space.S)
+        for s in np.random.randint(space.S, size=20):
+            self.assertEqual(agent._idx(*states[s]), s)
+        s = np.arange(space.S)
+        self.assertTrue(np.array_equal(space.index(*space.unindex(s)), s))
+        # Broadcasting one factor against the whole space
+        humanoid = space.values(0).ravel()
+        self.assertTrue(np.array_equal(humanoid, space.unindex(s)[0]))
+
+    def test_factored_transitions(self):
+        agent = GridAgent(2, 2)
+        transitions = agent.get_transitions()
+        S = transitions.S
+        # Predicting every certain belief gives the dense transition function
+        dense = np.stack([transitions.predict(np.eye(S)[s], a) for s in range(S) for a in range(Action.N)])
+        dense = dense.reshape(S, Action.N, S)
+        self.assertTrue(np.allclose(dense.sum(axis=2), 1.0))
+        for s, a, s1 in zip(np.random.randint(S, size=50), np.random.randint(Action.N, size=50),
+                            np.random.randint(S, size=50)):
+            self.assertAlmostEqual(transitions.probability(s, a, s1), dense[s, a, s1])
+        for s, a in zip(np.random.randint(S, size=20), np.random.randint(Action.N, size=20)):
+            self.assertLess(0.0, dense[s, a, transitions.sample(s, a)])
+        # Attacking a neighbouring wolf moves the humanoid onto it
+        s = agent._idx((0, 0), (1, 1), None, 0)
+        self.assertEqual(transitions.unindex(transitions.sample(s, Action.ATTACK))[0], 3)
+
+    def test_rewards(self):
+        agent = GridAgent(2, 2)
+        transitions = agent.get_transitions()
+        rewards = agent.construct_reward()
+        self.assertEqual(rewards.shape, (Action.N, transitions.S))
+        self.assertEqual(rewards[Action.ATTACK, agent._idx((0, 1), (0, 1), None, 0)], agent.attack_reward)
+        self.assertEqual(rewards[Action.ATTACK, agent._idx((0, 1), (1, 1), (0, 1), 0)], 0.0)
+        self.assertEqual(rewards[Action.EAT, agent._idx((0, 1), (1, 1), (0, 1), 0)], agent.eat_reward)
+        # Nothing is caught or eaten in the unknown cell
+        self.assertEqual(rewards[Action.ATTACK, agent._idx(None, None, None, 0)], 0.0)
+        self.assertTrue(np.all(rewards[Action.EXPLORE] == agent.explore_reward))
+        self.assertTrue(np.all(rewards[Action.FLEE] == 0.0))
+        # The expectation over arrival states, contracted factor by factor
+        expected = agent.expected_rewards(transitions)
+        for s in np.random.randint(transitions.S, size=10):
+            for a in range(Action.N):
+                arrival = transitions.predict(np.eye(transitions.S)[s], a)
+                self.assertAlmostEqual(expected[s, a], arrival.dot(rewards[a]))
+
+    def test_model_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = GridModelCache(directory)
+            transitions, observations, rewards = cache.get(GridAgent(3, 3))
+            self.assertIs(cache.get(GridAgent(3, 3))[0], transitions)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            # A new process loads the saved tables instead of building them
+            loaded, loaded_observations, loaded_rewards = GridModelCache(directory).get(GridAgent(3, 3))
+            self.assertFalse(loaded.factors[1].matrices[0].flags.writeable)
+            belief = np.random.dirichlet(np.ones(transitions.S))
+            for a in range(Action.N):
+                self.assertTrue(np.allclose(loaded.predict(belief, a), transitions.predict(belief, a)))
+            for table, loaded_table in zip(observations.tables, loaded_observations.tables):
+                self.assertTrue(np.array_equal(table, loaded_table))
+            self.assertTrue(np.array_equal(rewards, loaded_rewards))
+            self.assertNotEqual(GridModelCache(directory).get(GridAgent(2, 2))[0].S, transitions.S)
+            self.assertEqual(len(os.listdir(directory)), 2)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_product_belief(self):
+        agent = GridAgent()
+        transitions = agent.get_transitions()
+        belief = ProductBelief([np.random.dirichlet(np.ones(n)) for n in transitions.shape])
+        joint = transitions.predict(belief.joint(), Action.EXPLORE).reshape(transitions.shape)
+        predicted = belief.predict(transitions, Action.EXPLORE)
+        for f, marginal in enumerate(predicted.marginals):
+            others = tuple(axis for axis in range(len(transitions.shape)) if axis != f)
+            self.assertTrue(np.allclose(joint.sum(axis=others), marginal))
+        agent.update_belief(((2, 3), None, (0, 1), HealthObservation.OK))
+        humanoid, wolf, food, health = agent.belief.marginals
+        self.assertEqual(humanoid.argmax(), agent._cell((2, 3)))
+        self.assertEqual(food.argmax(), agent._cell((0, 1)))
+        self.assertEqual(health.argmax(), HealthObservation.OK)
+        # An unseen wolf leaves its marginal uniform
+        self.assertTrue(np.allclose(wolf, 1.0 / agent.L))
 
 if __name__ == "__main__a":
     unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from time import time
+import numpy as np
+from pcog import pomdp
+from pcog.pbvi import PBVI
+from pcog.qmdp import QMDP, FIB, entropy
+from pcog.sparse_model import SparseModel
+from pcog.tiger_door import makeTigerProblem, A_LISTEN, A_LEFT, A_RIGHT, TIG_LEFT, TIG_RIGHT
+
+
+class NumpyPOMDPTest(unittest.TestCase):
+    def test_update_belief(self):
+        model = makeTigerProblem()
+        belief = pomdp.updateBelief(model, [0.5, 0.5], A_LISTEN, TIG_LEFT)
+        self.assertTrue(np.allclose(belief, [0.85, 0.15]))
+        beliefs = pomdp.updateBelief(model, np.array([[0.5, 0.5], [0.85, 0.15]]), A_LISTEN, TIG_RIGHT)
+        self.assertTrue(np.allclose(beliefs, [[0.15, 0.85], [0.5, 0.5]]))
+
+    def test_sample_sor(self):
+        model = makeTigerProblem()
+        for _ in range(100):
+            s1, o, r = model.sampleSOR(TIG_LEFT, A_LISTEN)
+            self.assertEqual(s1, TIG_LEFT)
+            self.assertIn(o, [TIG_LEFT, TIG_RIGHT])
+            self.assertEqual(r, -1.0)
+
+    def test_expected_rewards(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        expected = QMDP().q_values(model)
+        # Tiger rewards do not depend on the arrival state, so (S, A) rewards give the same model
+        model.setRewardFunction(model.getRewardFunction()[:, :, 0])
+        s1, o, r = model.sampleSOR(TIG_LEFT, A_LISTEN)
+        self.assertEqual(r, -1.0)
+        self.assertEqual(model.getExpectedReward(TIG_LEFT, A_LISTEN, TIG_RIGHT), -1.0)
+        self.assertTrue(np.allclose(QMDP().q_values(model), expected))
+
+    def test_invalid_functions(self):
+        model = pomdp.Model(2, 2, 1)
+        with self.assertRaises(ValueError):
+            model.setTransitionFunction([[[0.5, 0.4]], [[0.0, 1.0]]])
+        with self.assertRaises(ValueError):
+            model.setObservationFunction([[1.0, 0.0]])
+
+    def test_pomcp(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        solver = pomdp.POMCPModel(model, 100, 200, 10.0)
+        self.assertIn(solver.sampleAction([0.5, 0.5], 3), range(model.getA()))
+
+    def test_pomcp_keeps_subtree(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        solver = pomdp.POMCPModel(model, 100, 200, 10.0)
+        solver.sampleAction([0.5, 0.5], 3)
+        # The most simulated subtree one step down
+        a, o, subtree = max([(a, o, child) for a, action in enumerate(solver.graph.children)
+                             for o, child in action.children.items()], key=lambda branch: branch[2].visits)
+        self.assertLess(0, subtree.visits)
+        solver.sampleAction(a, o, 3)
+        self.assertIs(solver.graph, subtree)
+        self.assertEqual(subtree.visits, 200)
+
+    def test_pomcp_deadline(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        solver = pomdp.POMCPModel(model, 100, 10 ** 7, 10.0, deadline=50)
+        start = time()
+        self.assertIn(solver.sampleAction([0.5, 0.5], 10), range(model.getA()))
+        self.assertLess(time() - start, 1.0)
+        self.assertLess(0, solver.simulations)
+        self.assertEqual(solver.simulations, solver.graph.visits)
+
+    def test_pbvi(self):
+        np.random.seed(0)
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        policy = PBVI()(model)
+        self.assertEqual(policy.sampleAction([0.5, 0.5]), A_LISTEN)
+        self.assertEqual(policy.sampleAction([0.0, 1.0]), A_LEFT)
+        self.assertEqual(policy.sampleAction([1.0, 0.0]), A_RIGHT)
+        # The optimal value of the uniform belief is about 19.4
+        self.assertAlmostEqual(policy.value([0.5, 0.5]), 19.4, delta=1.0)
+
+    def test_planners_use_sparse_matrices(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        sparse = SparseModel.from_dense(model.transitions, model.observations, model.rewards, 0.95)
+        # Planning must not densify the model
+        sparse.to_dense = None
+        for solver in (PBVI, QMDP):
+            np.random.seed(0)
+            expected = solver()(model).value([0.5, 0.5])
+            np.random.seed(0)
+            self.assertAlmostEqual(solver()(sparse).value([0.5, 0.5]), expected)
+
+    def test_qmdp(self):
+        model = makeTigerProblem()
+        model.setDiscount(0.95)
+        for solver in (QMDP(), FIB()):
+            policy = solver(model)
+            self.assertEqual(policy.sampleAction([0.0, 1.0]), A_LEFT)
+            self.assertEqual(policy.sampleAction([1.0, 0.0]), A_RIGHT)
+        # Observations can only lower the bound, and both bound the point-based value from above
+        qmdp, fib = QMDP().q_values(model), FIB().q_values(model)
+        self.assertTrue(np.all(fib <= qmdp + 1e-6))
+        self.assertLess(PBVI()(model).value([0.5, 0.5]), FIB()(model).value([0.5, 0.5]))
+
+    def test_entropy(self):
+        self.assertEqual(entropy([0.0, 1.0]), 0.0)
+        self.assertAlmostEqual(entropy([0.25, 0.25, 0.25, 0.25]), 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,17 @@
 import unittest
+import itertools
 import random
 import pickle
+import numpy as np
+import os
+import tempfile
+import shutil
 from pcog.usm import *
 from pcog.usm_draw import *
 from pcog.usm_pomdp import build_pomdp_model, solve, belief_state
+from pcog.usm_pomdp import transition_tensor, observation_tensor, reward_tensor
+from pcog.usm_pomdp import IncrementalModel, BeliefIndex, SearchPlanner, sparse_model
+from pcog.diagnostics import DiagnosticsSink, describe
 
 
 class USMTest(unittest.TestCase):
@@ -111,17 +119,352 @@ class USMTest(unittest.TestCase):
         ])
         self.assertAlmostEqual(sum(bs), 1.0)
 
+    def test_belief_index_is_memoised_per_version(self):
+        usm = self._generate_test_usm()
+        index = BeliefIndex(usm)
+        past = [Instance("a1", "o3", 1.0)]
+        belief = index.belief(past)
+        self.assertEqual(list(belief), belief_state(usm, past))
+        self.assertIs(index.belief([Instance("a1", "o3", 0.0)]), belief)
+        usm.insert(Instance("a3", "o3", 1.0))
+        self.assertIsNot(index.belief(past), belief)
+        self.assertAlmostEqual(sum(index.belief(past)), 1.0)
+
+    def test_belief_index_tracks_instances_of_internal_nodes(self):
+        random.seed(87)
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=1, known_actions=["a1", "a2"],
+                                known_observations=["o1", "o2"])
+        percepts = [(a, o) for a in ["a1", "a2"] for o in ["o1", "o2"]]
+        queries = [[Instance(a, o, 0.0) for a, o in query] for query in itertools.product(percepts, repeat=3)]
+        index = None
+        for step in range(200):
+            usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2"]), random.random()))
+            if index is None and 5 < step:
+                index = BeliefIndex(usm)
+            if index is not None:
+                for query in queries:
+                    fresh = BeliefIndex(usm, index.states).belief(query)
+                    self.assertTrue(np.array_equal(index.belief(query), fresh))
+
+    def test_search_planner_reuses_tree(self):
+        usm = self._generate_test_usm()
+        planner = SearchPlanner(usm, sparse_model(usm), belief_nodes=100, iterations=100, horizon=3)
+        a = planner.decide(usm.get_instances()[-1:])
+        usm.insert(Instance(usm.get_actions()[a], "o1", 1.0))
+        planner.decide(usm.get_instances()[-1:])
+        self.assertEqual(planner.reused, 1)
+        usm.insert(Instance("a3", "o1", 1.0))
+        planner.decide(usm.get_instances()[-1:])
+        self.assertEqual(planner.reused, 1)
+
     def test_that_usm_observation_function_works(self):
         with open('test/data/test_observation_usm', 'r') as f:
             usm = pickle.load(f)
             pomdp = build_pomdp_model(usm)
             self.assertEqual(True, True)
 
+    def test_observation_counts_match_instances(self):
+        tree = self._generate_random_usm(60)
+        for state in tree.get_states():
+            for action in ["a1", "a2", "a3"]:
+                assigned = [i for i in tree.get_instances()
+                            if i.get_node() is state and i.action == action]
+                self.assertEqual(state.observation_total(action), len(assigned))
+                for o in ["o1", "o2", "o3", "o4"]:
+                    count = len([i for i in assigned if i.observation == o])
+                    self.assertEqual(state.observation_counts.get(action, {}).get(o, 0), count)
+
+    def test_transition_counts_match_successors(self):
+        tree = self._generate_random_usm(80)
+        stack = [tree.get_root()]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.get_children())
+            if not isinstance(node, ActionNode):
+                continue
+            expected = {}
+            for i in node.instances:
+                if i.next is not None:
+                    successor = i.next.get_node().id
+                    expected[successor] = expected.get(successor, 0) + 1
+            self.assertEqual(node.transition_counts, expected)
+
+    def test_fringe_index_tracks_states(self):
+        tree = self._generate_random_usm(80)
+        indexed = [state for states in tree._fringe_index.values() for state in states]
+        self.assertEqual(len(indexed), len(tree.get_states()))
+        for key, states in tree._fringe_index.items():
+            for state in states:
+                self.assertIn(state, tree.get_states())
+                self.assertEqual(tree._state_key(state), key)
+
+    def test_reward_totals_match_instances(self):
+        tree = self._generate_test_usm()
+        tree.insert(Instance("a2", "o2", -3.0))
+        stack = [tree.get_root()]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.get_children())
+            self.assertAlmostEqual(node.reward_total, sum([i.reward for i in node.instances]))
+
+    def test_inserted_instances_view_the_log(self):
+        tree = self._generate_test_usm()
+        instances = tree.get_instances()
+        self.assertIs(instances[1].previous, instances[0])
+        self.assertIs(instances[1].next, instances[2])
+        self.assertIsNone(instances[0].previous)
+        self.assertIsNone(instances[-1].next)
+        self.assertEqual((instances[3].action, instances[3].observation), ("a1", "o3"))
+        self.assertTrue(instances[0].eql_i(Instance("a1", "o1", 0.0)))
+        self.assertFalse(instances[0].eql_i(instances[1]))
+        self.assertRaises(ValueError, tree.insert, instances[0])
+        copy_of_tree = pickle.loads(pickle.dumps(tree, 2))
+        self.assertEqual(len(copy_of_tree.get_states()), len(tree.get_states()))
+        self.assertEqual([i.reward for i in copy_of_tree.get_instances()], [i.reward for i in instances])
+
+    def test_max_instances_evicts_oldest(self):
+        tree = UtileSuffixMemory(window_size=3, fringe_depth=1, max_instances=20)
+        for k in range(200):
+            tree.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), float(k % 5)))
+        instances = tree.get_instances()
+        self.assertEqual(len(instances), 20)
+        self.assertEqual(instances[0].reward, float(180 % 5))
+        self.assertIsNone(instances[0].previous)
+        live = set(map(id, instances))
+        stack = [tree._root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.get_children())
+            self.assertTrue(all([id(i) in live for i in node.instances]))
+            self.assertAlmostEqual(node.reward_total, sum([i.reward for i in node.instances]))
+        for state in tree.get_states():
+            self.assertIsNotNone(state.parent)
+            self.assertAlmostEqual(sum(tree.transition_for(state, "a1")), 1.0)
+
+    def test_evicted_instances_leave_the_views(self):
+        tree = UtileSuffixMemory(window_size=3, fringe_depth=1, max_instances=20)
+        inserted = [Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2"]), float(k)) for k in range(150)]
+        for instance in inserted:
+            tree.insert(instance)
+        instances = tree.get_instances()
+        self.assertEqual(list(instances), inserted[-20:])
+        self.assertEqual(instances[-3:], inserted[-3:])
+        self.assertIs(instances[0], inserted[-20])
+        self.assertIs(instances[-1], inserted[-1])
+        self.assertRaises(IndexError, lambda: instances[20])
+        # Evicted rows are reclaimed instead of shifting the views on every eviction
+        self.assertLessEqual(len(tree.instance_log.views), 2 * 20)
+
+    def test_eviction_keeps_fringe_index(self):
+        random.seed(1)
+        tree = UtileSuffixMemory(window_size=4, fringe_depth=2, max_instances=12)
+        for k in range(120):
+            tree.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), float(k % 5)))
+        keys = dict(tree._fringe_keys)
+        index = dict([(key, set(states)) for key, states in tree._fringe_index.items()])
+        tree._reindex()
+        self.assertEqual(keys, tree._fringe_keys)
+        self.assertEqual(index, tree._fringe_index)
+
+    def test_eviction_after_unfringe_builds_models(self):
+        random.seed(44)
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=2, max_instances=25, known_actions=["a1", "a2"],
+                                known_observations=["o1", "o2", "o3"])
+        incremental = IncrementalModel(usm)
+        for k in range(1, 120):
+            usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), random.random()))
+            if k % 37 == 0:
+                usm.unfringe(alpha=1.0)
+            transitions = transition_tensor(usm, list(usm.get_states()))
+            self.assertTrue(np.allclose(transitions.sum(axis=2), 1.0))
+        incremental.update()
+        self.assertEqual(set([state for state in incremental.states if state is not None]), set(usm.get_states()))
+
+    def test_save_and_load(self):
+        usm = self._generate_random_usm(60)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            usm.save(path)
+            loaded = UtileSuffixMemory.load(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(loaded.window_size, usm.window_size)
+        self.assertEqual(loaded.fringe_depth, usm.fringe_depth)
+        self.assertEqual(loaded.display(), usm.display())
+        self.assertEqual(len(loaded.get_states()), len(usm.get_states()))
+        self.assertEqual([(i.action, i.observation, i.reward) for i in loaded.get_instances()],
+                         [(i.action, i.observation, i.reward) for i in usm.get_instances()])
+        loaded.insert(Instance("a1", "o1", 1.0))
+        self.assertEqual(len(loaded.get_instances()), 61)
+
+    def test_save_leaves_memory_unchanged(self):
+        random.seed(3)
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=2, max_instances=20)
+        for k in range(47):
+            usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), float(k % 5)))
+        log = usm.instance_log
+        self.assertLess(log._base, log.offset)
+        before = (log._base, log.offset, log.settled, list(log.views), list(log.action_values),
+                  list(log.observation_values), usm.version)
+        columns = dict([(name, getattr(log, name).copy())
+                        for name in ('actions', 'observations', 'rewards', 'nodes', 'member_offsets', 'member_nodes')])
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            usm.save(path)
+            loaded = UtileSuffixMemory.load(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(before, (log._base, log.offset, log.settled, list(log.views), list(log.action_values),
+                                  list(log.observation_values), usm.version))
+        for name, column in columns.items():
+            self.assertTrue(np.array_equal(column, getattr(log, name)))
+        self.assertEqual(loaded.display(), usm.display())
+        self.assertEqual([(i.action, i.observation, i.reward) for i in loaded.get_instances()],
+                         [(i.action, i.observation, i.reward) for i in usm.get_instances()])
+        self.assertEqual([sorted(loaded.instance_log.memberships(i._index)) for i in loaded.get_instances()],
+                         [sorted(log.memberships(i._index)) for i in usm.get_instances()])
+
+    def test_utility_matrix_matches_rewards(self):
+        tree = self._generate_test_usm()
+        leaves = tree.tree_leaves()
+        tree.utility_matrix(leaves)
+        tree.insert(Instance("a2", "o2", 3.0))
+        leaves = tree.tree_leaves()
+        utilities = tree.utility_matrix(leaves)
+        for row, leaf in zip(utilities, leaves):
+            for utility, action in zip(row, tree.get_actions()):
+                self.assertAlmostEqual(utility, leaf.reward(action))
+            self.assertAlmostEqual(tree.utility(leaf), max([leaf.reward(a) for a in tree.get_actions()]))
+
+    def test_insert_many_matches_insert(self):
+        percepts = [(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), random.random())
+                    for _ in range(80)]
+        tree = UtileSuffixMemory(window_size=3, fringe_depth=1)
+        for a, o, r in percepts:
+            tree.insert(Instance(a, o, r))
+        batched = UtileSuffixMemory(window_size=3, fringe_depth=1)
+        batched.insert(Instance(*percepts[0]))
+        batched.insert_many([Instance(a, o, r) for a, o, r in percepts[1:]])
+        self.assertEqual(batched.display(), tree.display())
+        self.assertEqual(len(batched.get_states()), len(tree.get_states()))
+        self.assertEqual([i.get_node().is_fringe for i in batched.get_instances()],
+                         [i.get_node().is_fringe for i in tree.get_instances()])
+        self.assertRaises(ValueError, batched.insert_many, batched.get_instances()[-1:])
+
+    def test_tensors_match_functions(self):
+        tree = self._generate_test_usm()
+        states = list(tree.get_states())
+        transitions = transition_tensor(tree, states)
+        observations = observation_tensor(tree, states)
+        rewards = reward_tensor(tree, states)
+        self.assertEqual(transitions.shape, (len(states), 2, len(states)))
+        self.assertEqual(observations.shape, (len(states), 2, 3))
+        for s, state in enumerate(states):
+            for a, action in enumerate(tree.get_actions()):
+                for expected, actual in zip(tree.transition_for(state, action), transitions[s, a]):
+                    self.assertAlmostEqual(expected, actual)
+                for expected, actual in zip(tree.observation_for(state, action), observations[s, a]):
+                    self.assertAlmostEqual(expected, actual)
+                for actual in rewards[s, a]:
+                    self.assertAlmostEqual(state.reward(action), actual)
+
+    def test_sparse_model_matches_tensors(self):
+        tree = self._generate_test_usm()
+        states = list(tree.get_states())
+        model = sparse_model(tree, states)
+        transitions, observations, rewards = model.to_dense()
+        self.assertTrue(np.allclose(transitions, transition_tensor(tree, states)))
+        self.assertTrue(np.allclose(observations, observation_tensor(tree, states)))
+        self.assertTrue(np.allclose(rewards, reward_tensor(tree, states)))
+        belief = np.full(len(states), 1.0 / len(states))
+        expected = belief.dot(transitions[:, 0, :]) * observations[:, 0, 0]
+        self.assertTrue(np.allclose(model.update_belief(belief, 0, 0), expected / expected.sum()))
+        s1, o, r = model.sampleSOR(0, 1)
+        self.assertLess(0.0, transitions[0, 1, s1])
+        self.assertLess(0.0, observations[s1, 1, o])
+
+    def test_incremental_model_matches_tensors(self):
+        random.seed(3)
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=1, known_actions=["a1", "a2"],
+                                known_observations=["o1", "o2", "o3"])
+        incremental = IncrementalModel(usm)
+        for regeneration in range(4):
+            for i in range(25):
+                usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), random.random()))
+            previous = list(incremental.states)
+            incremental.update()
+            for state, current in zip(previous, incremental.states):
+                if current is not None:
+                    self.assertIs(state, current)
+            indices = [idx for idx, state in enumerate(incremental.states) if state is not None]
+            states = [incremental.states[idx] for idx in indices]
+            self.assertEqual(set(states), set(usm.get_states()))
+            transitions, observations, rewards = incremental.model(sparse=True).to_dense()
+            self.assertTrue(np.allclose(transitions[indices][:, :, indices], transition_tensor(usm, states)))
+            self.assertTrue(np.allclose(observations[indices], observation_tensor(usm, states)))
+            self.assertTrue(np.allclose(rewards[indices][:, :, indices], reward_tensor(usm, states)))
+        usm.insert(Instance("a1", "o1", 1.0))
+        self.assertLess(incremental.update(), len(incremental.states) * 2)
+
+    def test_unfringe_promotes_leaves_to_states(self):
+        random.seed(2)
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=1, known_actions=["a1", "a2"],
+                                known_observations=["o1", "o2", "o3"])
+        incremental = IncrementalModel(usm)
+        for i in range(30):
+            usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2", "o3"]), random.random()))
+        incremental.update()
+        self.assertTrue(usm.unfringe(alpha=1.0))
+        self.assertEqual(set(usm.get_states()), set([node for node in usm.tree_leaves() if node.is_leaf()]))
+        transitions = build_pomdp_model(usm).getTransitionFunction()
+        self.assertTrue(np.allclose(np.sum(transitions, axis=2), 1.0))
+        incremental.update()
+        self.assertEqual(set([state for state in incremental.states if state is not None]), set(usm.get_states()))
+        for matrix in incremental.transition_matrices():
+            rows = np.asarray(matrix.sum(axis=1)).ravel()
+            self.assertTrue(np.allclose(rows[[state is not None for state in incremental.states]], 1.0))
+
+    def test_diagnostics_sink_writes_models(self):
+        tree = self._generate_test_usm()
+        states = list(tree.get_states())
+        directory = tempfile.mkdtemp()
+        try:
+            sink = DiagnosticsSink(directory)
+            build_pomdp_model(tree, diagnostics=sink)
+            build_pomdp_model(tree, sparse=True, diagnostics=sink)
+            sink.close()
+            self.assertEqual(sorted(os.listdir(directory)), ["model-0000.npz", "model-0001.npz"])
+            dense = np.load(os.path.join(directory, "model-0000.npz"))
+            self.assertTrue(np.allclose(dense["transitions"], transition_tensor(tree, states)))
+            stacked = np.load(os.path.join(directory, "model-0001.npz"))
+            S, A, _ = stacked["transitions_shape"]
+            self.assertEqual((S, A), (len(states), len(tree.get_actions())))
+            self.assertEqual(len(stacked["transitions_indptr"]), S * A + 1)
+        finally:
+            shutil.rmtree(directory)
+        summary = describe(*sparse_model(tree).to_dense())
+        self.assertIn("row sum error", summary)
+
     def test_derive_new(self):
         usm = self._generate_test_usm()
         copy_of_usm = usm.derive_new()
         self.assertEqual(len(copy_of_usm.get_states()), len(usm.get_states()))
         self.assertEqual(len(copy_of_usm.get_instances()), len(usm.get_instances()))
 
+    def test_derive_new_is_independent_copy(self):
+        usm = UtileSuffixMemory(window_size=3, fringe_depth=1)
+        for i in range(30):
+            usm.insert(Instance(random.choice(["a1", "a2"]), random.choice(["o1", "o2"]), 1.0))
+        copy_of_usm = usm.derive_new()
+        self.assertEqual(copy_of_usm.fringe_depth, 1)
+        self.assertEqual(copy_of_usm.display(), usm.display())
+        self.assertIsNot(copy_of_usm.get_instances()[0], usm.get_instances()[0])
+        copy_of_usm.insert(Instance("a3", "o3", 1.0))
+        self.assertEqual(len(usm.get_instances()), 30)
+        self.assertIsNone(usm.get_root().child("a3"))
+        self.assertIsNotNone(copy_of_usm.get_root().child("a3"))
+
 if __name__ == "__main__": 
     unittest.main()